@@ -1,784 +1,1160 @@
-"""
-==================================
-// LICENSE:
-// Copyright 2024 University of Sydney
-// Use of this source code is governed by an MIT-style
-// license that can be found in the LICENSE file or at
-// https://opensource.org/licenses/MIT.
-// ===============================
-// AUTHOR       : Qinlin (Alistair) Gu, 
-//                modified based on Dr. Clara Grazian's original R code.
-// CREATE DATE  : 26/03/2024
-// PURPOSE      : To perform the vABC algorithm using GPU acceleration.
-// SPECIAL NOTES:
-// ===============================
-// Change History:
-// 20/06/2024 - Qinlin (Alistair) Gu - Copied from the 2TCM version and modified
-//                                     for the 1K version.
-==================================
-"""
-
-import cupy as cp
-import pandas as pd
-import numpy as np
-from scipy.signal import convolve as sp_convolve
-import os
-import warnings
-from tqdm import tqdm
-
-# Filter out FutureWarnings in Pandas
-warnings.filterwarnings("ignore", category=FutureWarning)
-
-def extract_values(df):
-    """
-    Extracts the values from the given DataFrame.
-
-    Args:
-        df (pd.DataFrame): Input DataFrame.
-
-    Returns:
-        tuple: A tuple containing the extracted values.
-            Each has a shape of (num_time_frame).
-    """
-    time_frame_size = cp.array(df.iloc[:, 0]).astype(cp.float32)
-    Ti = cp.array(df.iloc[:, 1].values).astype(cp.float32)
-    Cb = cp.array(df.iloc[:, 2].values).astype(cp.float32)
-
-    return time_frame_size, Cb, Ti
-
-def extract_TAC_chunks(df, index, chunk_size, num_voxel):
-    """
-    Extracts chunks of TAC (Time-Activity Curve) from the given DataFrame.
-    Chunks are used so that only a proportion of the data is loaded into memory 
-        at a time, preventing memory overflow.
-
-    Args:
-        df (pd.DataFrame): Input DataFrame.
-        index (int): Starting index of the chunk.
-        chunk_size (int): Size of each chunk.
-        num_voxel (int): Number of voxels.
-
-    Returns:
-        cp.ndarray: Extracted TAC chunks, shaped as (num_time_frame, num_voxel).
-    """
-    df_column_size = df.shape[1]
-    num_of_other_columns = 3 ## 3 columns are for time_frame_size, Cb, and Ti
-    if num_voxel is None: ## When None, use all voxels
-        num_voxel = df_column_size - num_of_other_columns
-    chunk_end = min(index + chunk_size, df_column_size, num_voxel + num_of_other_columns)
-    Ct = cp.array(df.iloc[:, index: chunk_end].values).astype(cp.float32)
-
-    return Ct
-
-def output_file_init(path_output_para, path_output_model, write_paras, output_compressed):
-    """
-    Initializes the output files for parameter and model data, so that results
-        can be recorded in chunks.
-
-    Args:
-        path_output_para (str): Path to the parameter output file.
-        path_output_model (str): Path to the model output file.
-        write_paras (bool): flag indicating whether to write parameter posterior.
-        output_compressed (bool): flag indicating whether to compress the output 
-                                  posteriors (hdf5/csv). Note that the model 
-                                  probability posterior is always stored as a csv
-                                  as it is relatively small.
-    """
-    para_columns = ["Voxel_No", "V_b", "K_1", "k_2", 
-                    "k_3", "k_4", "K_b", "V_T", "model"]
-    num_of_columns = len(para_columns)
-    model_p_columns = ["Voxel_No", "model", "probability_of_model"]
-
-    if write_paras:
-        para_df = pd.DataFrame(columns = para_columns)
-        para_df.iloc[:, 0] = para_df.iloc[:, 0].astype(np.int32)
-        para_df.iloc[:, 1:num_of_columns-1] = para_df.iloc[:, 1:num_of_columns-1].astype(np.float32)
-        para_df.iloc[:, -1] = para_df.iloc[:, -1].astype(np.str_)
-        if output_compressed:
-            para_df.to_hdf(path_output_para, 
-                           key = "column_names", 
-                           format='table', 
-                           index = False, 
-                           mode = "w", 
-                           complevel = 9)
-        else:
-            para_df.to_csv(path_output_para, 
-                           index = False, 
-                           mode = "w", 
-                           # compression = "xz"
-                           )
-
-    model_p_df = pd.DataFrame(columns = model_p_columns)
-    model_p_df.to_csv( ## csv first, compression later, otherwise slow
-        path_output_model.replace("h5", "csv"), 
-        index = False, 
-        mode = "w", 
-        # compression = "xz"
-        )
-
-def output_dataframe(para, model_p, write_paras):
-    """
-    Prepares the output DataFrames for parameter and model data.
-
-    Args:
-        para (cp.ndarray): Parameter data. Contains Vb, alpha1, alpha2, theta1,
-            theta2, and model values.
-        model_p (cp.ndarray): Model data.
-        write_paras (bool): flag indicating whether to write parameter posterior.
-
-    Returns:
-        tuple: A tuple containing the prepared DataFrames.
-            para_df is the parameter posterior DataFrame. (K_1 etc.)
-            model_p_df is the model probability posterior DataFrame.
-    """
-    if write_paras:
-        para_df = pd.DataFrame(para)
-        para_df[0] = para_df.iloc[:, 0].astype(int)
-
-        ## We have alpha1 alpha2 theta1 theta2
-        ## We need K_1 k_2 k_3 k_4
-
-        V_b = para_df.iloc[:, 1]
-        alpha1 = para_df.iloc[:, 2]
-        alpha2 = para_df.iloc[:, 3]
-        theta1 = para_df.iloc[:, 4]
-        theta2 = para_df.iloc[:, 5]
-        K_b = para_df.iloc[:, 6]
-        models = para_df.iloc[:, 7]
-
-        K_1 = (theta1 + theta2) / (1 - V_b)
-        k_2 = (theta1 * alpha1 + theta2 * alpha2) / (theta1 + theta2)
-        k_4 = alpha1 * alpha2 / k_2
-        k_3 = alpha1 + alpha2 - k_2 - k_4
-        V_T = K_1 / k_2 * (1 + k_3 / k_4)
-        # K_i = K_1 * k_3 / (k_2 + k_3)
-
-        para_df.iloc[:, 2] = K_1
-        para_df.iloc[:, 3] = k_2
-        para_df.iloc[:, 4] = k_3
-        para_df.iloc[:, 5] = k_4
-        para_df.iloc[:, 6] = K_b
-        para_df.insert(7, "V_T", V_T)
-        para_df.iloc[:, 8] = models
-
-        para_df.iloc[:, -1] = para_df.iloc[:, -1].replace({0: '2TCM', 
-                                                           1: '2TCM-1K'})
-    else:
-        para_df = None
-
-    model_p_df = pd.DataFrame(model_p)
-    model_p_df[0] = model_p_df.iloc[:, 0].astype(int)
-    model_p_df[2] = model_p_df.iloc[:, 2].astype(float)
-    model_p_df.iloc[:, 2] = np.where(model_p_df.iloc[:, 1] == 1, 
-                                     1 - model_p_df.iloc[:, 2], 
-                                     model_p_df.iloc[:, 2])
-    model_p_df.iloc[:, 1] = model_p_df.iloc[:, 1].replace({0: '2TCM', 
-                                                           1: '2TCM-1K'})
-
-    return para_df, model_p_df
-
-def write_csv_chunks(para_df, 
-                     model_p_df, 
-                     path_output_para, 
-                     path_output_model, 
-                     write_paras, 
-                     output_compressed):
-    """
-    Writes the parameter and model data to CSV files in chunks.
-
-    Args:
-        para_df (pd.DataFrame): Parameter data.
-        model_p_df (pd.DataFrame): Model data.
-        path_output_para (str): Path to the parameter output file.
-        path_output_model (str): Path to the model output file.
-        write_paras (bool): flag indicating whether to write parameter posterior.
-        output_compressed (bool): flag indicating whether to compress the output 
-                                  posteriors (hdf5/csv). Note that the model 
-                                  probability posterior is always stored as a csv
-                                  as it is relatively small.
-    """
-    if write_paras:
-        para_columns = ["Voxel_No", "V_b", "K_1", "k_2", 
-                        "k_3", "k_4", "K_b", "V_T", "model"]
-        num_of_columns = len(para_columns)
-        para_df.columns = para_columns
-
-        unique_voxels = para_df.iloc[:, 0].unique()
-        min_index = np.min(unique_voxels)
-        max_index = np.max(unique_voxels)
-        para_df.iloc[:, 0] = para_df.iloc[:, 0].astype(np.int32)
-        para_df.iloc[:, 1:num_of_columns-1] = para_df.iloc[:, 1:num_of_columns-1].astype(np.float32)
-        para_df.iloc[:, -1] = para_df.iloc[:, -1].astype(np.str_)
-        if output_compressed:
-            para_df.to_hdf(path_output_para, 
-                        key = f"voxel_{min_index}_{max_index}", 
-                        format='table', 
-                        index = False, 
-                        mode = 'a', 
-                        complevel = 9, 
-                        min_itemsize = {'model': 11})
-        else:
-            para_df.to_csv(
-                path_output_para, 
-                header = False, 
-                index = False, 
-                mode = "a", 
-                # compression = "xz"
-                )
-
-    model_p_df.to_csv(
-        path_output_model.replace("h5", "csv"), 
-        header = False, 
-        index = False, 
-        mode = "a", 
-        # compression = "xz"
-        )
-    
-def compress_csv(path_output_model):
-    """
-    Compresses the model output CSV file to HDF5 format, when all are done
-
-    Args:
-        path_output_model (str): Path to the model output file.
-    """
-    path_output_model_csv = path_output_model.replace("h5", "csv")
-    df = pd.read_csv(path_output_model_csv)
-    df.iloc[:, 0] = df.iloc[:, 0].astype(np.int32)
-    df.iloc[:, 1] = df.iloc[:, 1].astype(np.str_)
-    df.iloc[:, 2] = df.iloc[:, 2].astype(np.float32)
-    df.to_hdf(path_output_model, 
-              key = "df", 
-              index = False, 
-              mode = "w", 
-              complevel = 9)
-
-    if os.path.exists(path_output_model_csv):
-        os.remove(path_output_model_csv)
-
-def cumconv(a, b, time_frame_size):
-    """
-    Performs cumulative convolution of two arrays.
-
-    Args:
-        a (cp.ndarray): First array.
-        b (cp.ndarray): Second array.
-        time_frame_size (cp.ndarray): Time frame size.
-
-    Returns:
-        cp.ndarray: Result of the cumulative convolution, shaped as 
-            (1, num_prior_simulation_size, num_time_frame). The first dimension
-            is added to match the num_voxels.
-    """
-    num_time_frame = b.shape[-1]
-    a_cpu = a.get()
-    b_cpu = b.get()
-    ret = sp_convolve(a_cpu, b_cpu)[:, :, :num_time_frame]
-    ## Only takes the first num_time_frame elements because of how the function
-    ## works. This part is not very optimised. CuPy hasn't implemented SciPy's 
-    ## convolve function yet. But it is parallelised, so it's not too bad.
-    ret = cp.array(ret).astype(cp.float32)
-    ret = ret * time_frame_size
-
-    return ret
-
-def get_FDG_Ct(time_frame_size, Cb, Ca, Ti, paras):
-    """
-    Generates FDG (Fluorodeoxyglucose) model TACs using simulated priors.
-
-    Args:
-        time_frame_size (cp.ndarray): Time frame size.
-        Cb (cp.ndarray): Cb values.
-        Ca (cp.ndarray): Ca values.
-        Ti (cp.ndarray): Ti values.
-        paras (cp.ndarray): Parameter values. Contains Vb, alpha1, alpha2,
-            theta1, theta2, and model values.
-
-    Returns:
-        cp.ndarray: FDG model TACs, shaped as the return value of cumconv.
-    """
-    Vb, alpha1, alpha2, theta1, theta2, Kb, model = [row for row in paras]
-    Cb_cumsum = cp.cumsum(Cb, axis = -1)
-
-    Ct = cumconv((theta1 * cp.exp(-alpha1 * Ti) + theta2 * cp.exp(-alpha2 * Ti)), 
-                 Ca, time_frame_size) + Vb * Cb + Vb * Kb * Cb_cumsum * time_frame_size
-
-    return Ct
-
-def generate_FDG_models(time_frame_size, Cb, Ca, Ti, par_mat, finer_t_size):
-    """
-    A wrapper function to generate FDG models using the given parameters,
-    including fitting the input function for minimal convolution error.
-
-    Args:
-        time_frame_size (cp.ndarray): Time frame size.
-        Cb (cp.ndarray): Cb values.
-        Ca (cp.ndarray): Ca values.
-        Ti (cp.ndarray): Ti values.
-        par_mat (cp.ndarray): Parameter matrix.
-        finer_t_size (int): Finer time frame size for smaller convolution error.
-
-    Returns:
-        cp.ndarray: FDG model TACs using the prior simulations.
-    """
-    ## Fit the input function, and get the finer time frame
-    ## for smaller convolution error
-    input_function_args = fit_input_function(Ti, Cb)
-    Ti, time_frame_size, original_Ti_indices = get_finer_time_frame(Ti, finer_t_size)
-    Cb = input_function(Ti, *input_function_args)
-    Ca = Cb
-    print("Input function fitted...")
-
-    time_frame_size = time_frame_size[None, None, :]
-    Ca = Ca[None, None, :]
-    Cb = Cb[None, None, :]
-    Ti = Ti[None, None, :]
-    ## shape (1, 1, num_time_frame)
-    ## to match (num_vox, num_prior_simulation_size, num_time_frame)
-    paras = par_mat.T[:, None, :, None]
-    ## shape (num_variable, 1, num_prior_simulation_size, 1)
-    ## to match (num_variable, num_vox, num_prior_simulation_size, num_time_frame)
-
-    M = get_FDG_Ct(time_frame_size, Cb, Ca, Ti, paras)
-    M = M[..., original_Ti_indices]
-
-    print("Models generated...")
-
-    return M
-
-def distance_function(M, Ct, distance_type, validation_mode=False, 
-                      hyperparameter=None):
-    """
-    Calculates the distance function between the model and the observed data.
-    
-    Args:
-        M (cp.ndarray): FDG model TACs using the prior simulations.
-            (num_vox, num_prior_simulation_size, num_time_frame)
-        Ct (cp.ndarray): TAC chunks.
-            (num_vox, 1, num_time_frame)
-        distance_type (str): Type of distance function to use. Options are:
-            "L1", "L2", "Cauchy", "Huber", "Welsch", "CvM".
-            L1: L1 distance. L1 norm is the sum of the absolute values of the 
-                             vector.
-            L2: L2 distance. L2 norm is the square root of the sum of the 
-                             squared values of the vector.
-            Cauchy: Cauchy distance. Cauchy loss is the sum of the logarithm of 
-                                     1 plus the square of the vector divided by 
-                                     gamma.
-            Huber: Huber distance. Huber loss is the convolution of the absolute
-                                   value function with the rectangular function,
-                                   scaled and translated.
-            Welsch: Welsch distance. Welsch loss is the sum of 1 minus the 
-                                     exponential of the square of the vector 
-                                     divided by gamma.
-            CvM: Cramer-von Mises distance. CvM norm is the sum of the square of
-                                            the ranks of the vector.
-        validation_mode (bool): flag indicating whether to use validation mode.
-        hyperparameter (float): Hyperparameter value for the distance function.
-            Tunable.
-
-    Returns:
-        cp.ndarray: Errors calculated using the given distance function.
-    """
-    if distance_type == "L1":
-        errors = cp.sum(cp.abs(M - Ct), axis = -1)
-    elif distance_type == "L2":
-        errors = cp.sum(cp.square(M - Ct), axis = -1)
-    elif distance_type == "Cauchy":
-        gamma = hyperparameter if validation_mode else 19320.175439
-        errors = cp.sum(cp.log(1 + cp.square((M - Ct) / gamma)), axis = -1)
-    elif distance_type == "Huber":
-        delta = hyperparameter if validation_mode else 10925.438596
-        errors = cp.sum(cp.where(cp.abs(M - Ct) <= delta, 
-                                 0.5 * cp.square(M - Ct), 
-                                 delta * (cp.abs(M - Ct) - 0.5 * delta)), 
-                        axis = -1)
-    elif distance_type == "Welsch":
-        gamma = hyperparameter if validation_mode else 19701.754386
-        errors = cp.sum(1 - cp.exp(-cp.square((M - Ct) / gamma)), axis = -1)
-    elif distance_type == "CvM":
-        M_sorted = cp.sort(M, axis = -1)
-        Ct_sorted = cp.sort(Ct, axis = -1)
-        shape = (Ct_sorted.shape[0], M_sorted.shape[1], M_sorted.shape[2])
-        M_sorted = cp.broadcast_to(M_sorted, shape)
-        Ct_sorted = cp.broadcast_to(Ct_sorted, shape)
-        combined_sorted = cp.sort(
-            cp.concatenate((M_sorted, Ct_sorted), axis = -1), 
-            axis = -1
-            )
-        ranks_M = cp.sum(
-            combined_sorted[..., None, :] < M_sorted[..., None], 
-            axis = -1
-        )
-        ranks_Ct = cp.sum(
-            combined_sorted[..., None, :] < Ct_sorted[..., None],
-            axis = -1
-        )
-        M = M.shape[-1]
-        N = Ct.shape[-1]
-        i_list = cp.arange(M)
-        j_list = cp.arange(N)
-        U = M * cp.sum(cp.square(ranks_M - i_list), axis = -1) + \
-            N * cp.sum(cp.square(ranks_Ct - j_list), axis = -1)
-        errors = U / (M * N * (M + N)) - (4 * M * N - 1) / (6 * (M + N))
-        errors = errors + cp.random.normal(0, 0.0001, errors.shape)
-    else:
-        return distance_function(M, Ct, "L1")
-
-    return errors
-
-def calculate_results(M, par_mat, Ct, S, thresh, write_paras, 
-                      model_0_prob_thres=0.5, vox_num_start=0, 
-                      distance_type="L1", validation_mode=False, 
-                      hyperparameter=None):
-    """
-    Calculates the accepted simulations based on the given inputs.
-
-    Args:
-        M (cp.ndarray): FDG model TACs using the prior simulations.
-            (num_vox, num_prior_simulation_size, num_time_frame)
-        par_mat (cp.ndarray): Parameter matrix.
-            (num_prior_simulation_size, num_variable)
-        Ct (cp.ndarray): TAC chunks.
-            (num_time_frame, num_vox)
-        S (int): Prior simulation size. i.e. num_prior_simulation_size
-        thresh (float): Threshold value for acceptance. Tunable.
-        write_paras (bool): flag indicating whether to write parameter posterior.
-        model_0_prob_thres (float): Threshold for model 0 probability. Tunable.
-        vox_num_start (int): Starting voxel number. For batching purpose.
-        distance_type (str): Type of distance function to use. Options are:
-            "L1", "L2", "Cauchy", "Huber", "Welsch", "CvM".
-        validation_mode (bool): flag indicating whether to use validation mode.
-        hyperparameter (float): Hyperparameter value for the distance function.
-            Tunable.
-
-    Returns:
-        tuple: A tuple containing the accepted parameter posteriors and model 
-            probabilities.
-    """
-    num_vox = Ct.shape[-1]
-    num_variable = 7
-
-    voxel_numbers = cp.arange(num_vox) + vox_num_start
-
-    Ct = Ct.T[:, None, :] ## (num_vox, 1, num_time_frame), 
-                          ## second dimension for broadcasting
-    errors = distance_function(
-        M, 
-        Ct, 
-        distance_type = distance_type, 
-        validation_mode = validation_mode, 
-        hyperparameter = hyperparameter
-        )
-    ## calculate errors along time_frame axis
-    ## (num_vox, num_prior_simulation_size)
-    h = cp.quantile(errors, thresh, axis = -1) ## along num_prior_simulation_size axis
-                                               ## (num_vox)
-    accepted_mask = errors <= h[:, None] ## (num_vox, num_prior_simulation_size)
-    accepted_size = int(cp.count_nonzero(accepted_mask[0]))
-    ## This usually is fine but is risky
-    ## Sometimes for special distance functions, there can be ties
-    ## Leading to different accepted_size
-    ## Making the vectorisation of the code not work
-
-    ## was (num_prior_simulation_size, num_variable)
-    par_mat_broadcast_shape = (num_vox, S, num_variable)
-    par_mat = cp.broadcast_to(par_mat, par_mat_broadcast_shape)
-    ## to repeat the par_mat for each voxel, for output purpose
-    ## (num_vox, num_prior_simulation_size, num_variable)
-    accepted_mask = cp.broadcast_to(accepted_mask[:, :, None], 
-                                    par_mat_broadcast_shape)
-    ## mask was (num_vox, num_prior_simulation_size)
-    ## mask repeated for each variable
-    ## (num_vox, num_prior_simulation_size, num_variable)
-    accepted = par_mat[accepted_mask]
-    accepted = accepted.reshape(num_vox, accepted_size, num_variable)
-    ## reshaping needed because applying the mask will flatten the array
-    ## (num_vox, accepted_size, num_variable)
-    ## Errors will happen if accepted_size is different for different voxels
-    ## Potential risky distance functions include those using ranks
-
-    models = accepted[:, :, -1] ## (num_vox, accepted_size)
-                                ## array of models accepted for each voxel
-    percentage_zeros = cp.mean(models == 0, axis = -1) ## along accepted_size axis
-    models = (percentage_zeros < model_0_prob_thres).astype(cp.int32)
-    model_p = cp.column_stack((voxel_numbers, models, percentage_zeros))
-    model_p = model_p.get()
-
-    if write_paras:
-        accepted = accepted.reshape(num_vox * accepted_size, num_variable)
-        voxel_numbers = voxel_numbers.repeat(accepted_size)
-        accepted = cp.column_stack((voxel_numbers, accepted))
-        accepted = accepted.get()
-    else:
-        accepted = None
-
-    return accepted, model_p
-
-def input_function(t, beta_1, beta_2, beta_3, kappa_1, kappa_2, kappa_3):
-    """
-    Calculates the input function using the given parameters.
-
-    Args:
-        t (cp.ndarray): Time values.
-        beta_1 (cp.ndarray): beta_1 values.
-        beta_2 (cp.ndarray): beta_2 values.
-        beta_3 (cp.ndarray): beta_3 values.
-        kappa_1 (cp.ndarray): kappa_1 values.
-        kappa_2 (cp.ndarray): kappa_2 values.
-        kappa_3 (cp.ndarray): kappa_3 values.
-
-    Returns:
-        cp.ndarray: Input function values.
-    """
-    ## initial injection time
-    return (beta_1 * t - beta_2 - beta_3) * np.exp(-kappa_1 * t) \
-        + beta_2 * np.exp(-kappa_2 * t) + beta_3 * np.exp(-kappa_3 * t)
-
-def fit_input_function(Ti, Cb):
-    """
-    Fits the input function using the given parameters.
-
-    Args:
-        Ti (cp.ndarray): Time values.
-        Cb (cp.ndarray): whole blood radioactivity concentration values.
-
-    Returns:
-        tuple: A tuple containing the fitted parameters.
-    """
-    Ti_vec = cp.array(Ti)[None, :]
-    chosen_TAC_vec = cp.array(Cb)[None, :]
-
-    cp.random.seed(2024)
-    S = 10000000
-    thresh = 0.001
-
-    beta_1 = cp.random.uniform(150000, 700000, S)[:, None]
-    beta_2 = cp.random.uniform(0, 3000, S)[:, None]
-    beta_3 = cp.random.uniform(0, 3000, S)[:, None]
-    kappa_1 = cp.random.uniform(3, 10, S)[:, None]
-    kappa_2 = cp.random.uniform(0, 0.075, S)[:, None]
-    kappa_3 = cp.random.uniform(0, 0.075, S)[:, None]
-    error = cp.zeros(S)
-
-    # for i in tqdm(range(S)):
-    lambda_coef = 30
-    TACs = input_function(Ti_vec, beta_1, beta_2, beta_3, kappa_1, kappa_2, kappa_3)
-    error = cp.sum(cp.abs(chosen_TAC_vec - TACs), axis = -1) + \
-        lambda_coef * cp.abs(chosen_TAC_vec - TACs)[:, 2]
-    # Filter the best threshold quantile
-    threshold = cp.quantile(error, thresh)
-    filtered_indices = cp.where(error <= threshold)
-
-    # Filter the parameters
-    filtered_beta_1 = beta_1[filtered_indices].flatten()
-    filtered_beta_2 = beta_2[filtered_indices].flatten()
-    filtered_beta_3 = beta_3[filtered_indices].flatten()
-    filtered_kappa_1 = kappa_1[filtered_indices].flatten()
-    filtered_kappa_2 = kappa_2[filtered_indices].flatten()
-    filtered_kappa_3 = kappa_3[filtered_indices].flatten()
-
-    beta_1 = cp.median(filtered_beta_1)
-    beta_2 = cp.median(filtered_beta_2)
-    beta_3 = cp.median(filtered_beta_3)
-    kappa_1 = cp.median(filtered_kappa_1)
-    kappa_2 = cp.median(filtered_kappa_2)
-    kappa_3 = cp.median(filtered_kappa_3)
-
-    return beta_1, beta_2, beta_3, kappa_1, kappa_2, kappa_3
-
-def get_finer_time_frame(Ti, finer_t_size):
-    """
-    Gets the finer time frame for smaller convolution error.
-
-    Args:
-        Ti (cp.ndarray): Time values.
-        finer_t_size (int): Finer time frame size.
-
-    Returns:
-        cp.ndarray: Finer time frame values.
-    """
-    Ti = cp.array(Ti)
-    finer_t = cp.linspace(Ti[0], Ti[-1], finer_t_size)
-    # finer_t = cp.unique(cp.concatenate((Ti, finer_t))) ## needs to be uniform
-    frame_size = cp.concatenate((cp.array([0]), cp.diff(finer_t)))
-    original_Ti_indices = cp.searchsorted(finer_t, Ti)
-
-    return finer_t, frame_size, original_Ti_indices
-
-def vABC(num_voxel, path_data, path_output_para, path_output_model, par_mat, S, 
-         thresh, model_0_prob_thres, write_paras, input_compressed=False, 
-         output_compressed=False, chunk_size=25, finer_t_size=1000, 
-         distance_type="L1", validation_mode=False, hyperparameter=None):
-    """
-    Performs the vABC (Variational Approximate Bayesian Computation) algorithm.
-
-    Args:
-        num_voxel (int): Number of voxels to process. If None, all voxels are
-        path_data (str): Path to the input data file.
-        path_output_para (str): Path to the parameter posterior output file.
-        path_output_model (str): Path to the model probability posterior output file.
-        par_mat (cp.ndarray): Parameter matrix, size (num_prior_simulation_size, num_variable).
-        S (int): Size of the simulation. i.e. num_prior_simulation_size
-        thresh (float): Threshold value for acceptance. Tunable.
-        model_0_prob_thres (float): Threshold for model 0 probability. Tunable.
-        write_paras (bool): flag indicating whether to write parameter posterior.
-        input_compressed (bool): flag indicating whether the input data is compressed (hdf5/csv).
-        output_compressed (bool): flag indicating whether to compress the output 
-                                  posteriors (hdf5/csv). Note that the model 
-                                  probability posterior is always stored as a csv
-                                  as it is relatively small.
-        chunk_size (int): Size of each chunk. Used to prevent memory overflow.
-        finer_t_size (int): Finer time frame size for smaller convolution error.
-        distance_type (str): Type of distance function to use. Options are:
-            "L1", "L2", "Cauchy", "Huber", "Welsch", "CvM".
-        validation_mode (bool): flag indicating whether to use validation mode.
-        hyperparameter (float): Hyperparameter value for the distance function.
-            Tunable.
-    """
-    if input_compressed:
-        df = pd.read_hdf(path_data, "df") ## alter, use read_csv(chunksize=)
-    else:
-        df = pd.read_csv(path_data)
-    time_frame_size, Cb, Ti = extract_values(df)
-    Ca = Cb ## as a part of our hypothesis
-    print("Data extracted...")
-
-    M = None
-    if validation_mode:
-    ## If validation mode is on, try to load the models to save computation time
-        try:
-            M = cp.load("generated_models.npz")["M"]
-            print("Models loaded...")
-        except FileNotFoundError:
-            pass
-    if M is None:
-        M = generate_FDG_models(
-            time_frame_size, Cb, Ca, Ti, par_mat, finer_t_size
-        )
-        cp.savez_compressed("generated_models", M = M)
-    
-    index = 3 ## ignoring the first 3 columns
-              ## which are for time_frame_size, Cb, and Ti
-    df_column_size = df.shape[1] ## number of columns in the DataFrame
-
-    output_file_init(
-        path_output_para, 
-        path_output_model, 
-        write_paras, 
-        output_compressed
-        )
-    ## initialise the output files
-    print("Output files initialised...")
-
-    if num_voxel is None: ## When None, use all voxels
-        num_voxel = df_column_size - 3
-
-    # Calculate the number of iterations needed for the tqdm progress bar
-    total_iterations = min(num_voxel, df_column_size - 3) / chunk_size
-    total_iterations = int(total_iterations) if total_iterations.is_integer() else int(total_iterations) + 1
-
-    for _ in tqdm(range(total_iterations)):
-        ## batching to prevent memory overflow
-        if index >= df_column_size or index >= num_voxel + 3:
-            break
-
-        Ct = extract_TAC_chunks(df, index, chunk_size, num_voxel)
-        para, model_p = calculate_results(M, par_mat, Ct, S, thresh, write_paras, 
-                                          model_0_prob_thres, index - 3, 
-                                          distance_type = distance_type, 
-                                          validation_mode = validation_mode, 
-                                          hyperparameter = hyperparameter)
-        para_df, model_p_df = output_dataframe(para, model_p, write_paras)
-        write_csv_chunks(para_df, model_p_df, path_output_para, path_output_model, 
-                         write_paras, output_compressed)
-        
-        index += chunk_size
-
-    if output_compressed:
-        print("Compressing the model output...")
-        compress_csv(path_output_model)
-        print("Model output compressed...")
-
-    print("vABC algorithm completed!")
-
-def main():
-    """
-    Main function that executes the vABC algorithm.
-    """
-
-    """
-    Input data file should have the shape:
-    frame_length	Ti	        Cb	        0	        1	        2
-    0	            0.133333333	0.632698	0.040760215	0.036601037	0.028408282
-    0.166666667	    0.35	    140.5885	18.177458	17.420736	16.563547
-    0.166666667	    0.516666667	17912.979	0	        0	        0
-    0.166666667	    0.683333333	4444.976	8.17E-08	6.64E-08	4.08E-08
-    0.166666667	    0.85	    2675.443	0.001335959	0.000509933	0.000515968
-
-    The following columns are all TACs of the voxels.
-    frame_length is the time frame size.
-    Ti is the time after administration of the tracer.
-    Cb is the whole blood input function.
-        (Or equavalently Ca, the plasma input function)
-
-    If input data is an HDF5 file, the key should be "df".
-    """
-    path_data = "sample_data.csv"
-    path_output_para = "parameters.csv"
-    path_output_model = "model.csv"
-
-    seed = 2023
-    cp.random.seed(seed) ## for reproducibility
-
-    chunk_size = 25 ## Adjust as needed, to prevent memory overflow
-
-    S = 1*10**5 ## number of prior simulations
-    thresh = 0.023357214690901212 ## threshold for acceptance
-    model_0_prob_thres = 0.5 ## threshold for model 0 probability
-    num_voxel = None ## number of voxels to process. If None, all voxels are
-    write_paras = True ## flag indicating whether to write parameter posterior
-    input_compressed = False ## flag indicating whether the input data is compressed (hdf5/csv)
-    output_compressed = False
-    ## flag indicating whether to compress the output 
-    ## posteriors (hdf5/csv). Note that the model 
-    ## probability posterior is always stored as a csv initially
-    ## as it is relatively small, but can be compressed if needed.
-    finer_t_size = 500 ## finer time frame size for smaller convolution error
-                       ## bigger values require more vram
-    distance_type = "L1" ## distance function to use
-    ## 
-    validation_mode = False ## flag indicating whether to use validation mode
-
-    par_mat = None
-    if validation_mode:
-    ## If validation mode is on, try to load precomputed models to save 
-    ## computation time
-        try:
-            par_mat = cp.load("parameter_matrix.npz")["par_mat"]
-            print("Priors loaded...")
-        except FileNotFoundError:
-            pass
-    if par_mat is None:
-        Vb = cp.random.uniform(0, 0.1, S)
-        alpha1 = cp.random.uniform(0.0005, 0.02, S)
-        alpha2 = cp.random.uniform(0.06, 1, S)
-        theta1 = cp.random.uniform(0, 0.5, S)
-        theta2 = cp.random.uniform(0, 0.5, S)
-        Kb = cp.random.uniform(0, 0.9, S) ## 0.263±0.134, take 3 sds
-        model = cp.random.binomial(1, 0.5, S)
-        Kb[model == 0] = 0
-
-        par_mat = cp.column_stack((Vb, alpha1, alpha2, theta1, theta2, Kb, model))
-        ## stacked as input
-        cp.savez_compressed("parameter_matrix", par_mat = par_mat)
-        print("Priors generated...")
-
-    vABC(num_voxel, path_data, path_output_para, path_output_model, par_mat, 
-         S, thresh, model_0_prob_thres, write_paras, input_compressed, 
-         output_compressed, chunk_size, finer_t_size, 
-         distance_type = distance_type, validation_mode = validation_mode, 
-         hyperparameter = None)
-    
-if __name__ == "__main__":
-    print("Starting vABC algorithm...")
+"""
+==================================
+// LICENSE:
+// Copyright 2024 University of Sydney
+// Use of this source code is governed by an MIT-style
+// license that can be found in the LICENSE file or at
+// https://opensource.org/licenses/MIT.
+// ===============================
+// AUTHOR       : Qinlin (Alistair) Gu, 
+//                modified based on Dr. Clara Grazian's original R code.
+// CREATE DATE  : 26/03/2024
+// PURPOSE      : To perform the vABC algorithm using GPU acceleration.
+// SPECIAL NOTES:
+// ===============================
+// Change History:
+// 27/08/2026 - Qinlin (Alistair) Gu - Compressed outputs now stream straight
+//                                     into extendable HDF5 datasets; the
+//                                     csv-then-compress step is removed.
+// 27/08/2026 - Qinlin (Alistair) Gu - chunk_size = None (new default) probes
+//                                     free GPU memory and sizes batches
+//                                     adaptively per distance type.
+// 27/08/2026 - Qinlin (Alistair) Gu - Priors are drawn from scrambled Sobol
+//                                     sequences; scipy is now a dependency.
+// 27/08/2026 - Qinlin (Alistair) Gu - Optional CUDA graph replay of the
+//                                     per-chunk pipeline (use_cuda_graph).
+// 27/08/2026 - Qinlin (Alistair) Gu - Fused GPU distance kernel, fixed-count
+//                                     partition acceptance, and pinned
+//                                     asynchronous transfers.
+// 27/08/2026 - Qinlin (Alistair) Gu - Replaced the host-side convolution with
+//                                     a batched GPU FFT convolution.
+// 20/06/2024 - Qinlin (Alistair) Gu - Copied from the 2TCM version and modified
+//                                     for the 1K version.
+==================================
+"""
+
+import cupy as cp
+import pandas as pd
+import numpy as np
+from scipy.stats import qmc
+from cupyx.scipy.fft import next_fast_len
+import h5py
+import os
+import warnings
+from tqdm import tqdm
+
+# Filter out FutureWarnings in Pandas
+warnings.filterwarnings("ignore", category=FutureWarning)
+
+MODEL_NAMES = ("2TCM", "2TCM-1K")
+MEMORY_POOL = cp.get_default_memory_pool()
+## the pool the installed allocator actually serves from; main rebinds
+## this when it switches to the stream-ordered pool, so pool trims always
+## reach the active allocator instead of a bypassed one
+PARA_ROW_DTYPE = np.dtype([("Voxel_No", "i4"), ("V_b", "f4"), 
+                           ("K_1", "f4"), ("k_2", "f4"), ("k_3", "f4"), 
+                           ("k_4", "f4"), ("K_b", "f4"), ("V_T", "f4"), 
+                           ("model", "U7")])
+PARA_ROW_FMT = "%d,%.9g,%.9g,%.9g,%.9g,%.9g,%.9g,%.9g,%s"
+## one typed record per accepted simulation for the csv path; the format
+## string mirrors the fields, so the writer never goes through pandas
+## names of model codes 0 and 1, used wherever the numeric model column is
+## rendered for output
+
+## Fused |M - Ct| reduction over the time-frame axis. A single reduction
+## kernel streams over the prior simulations without ever materialising the
+## (num_vox, num_prior_simulation_size, num_time_frame) difference tensor
+## that cp.abs(M - Ct) would allocate. Defined at module scope so the JIT
+## compilation happens only once. The inputs are upcast on load and the
+## accumulator is fixed at float32, so the summation stays accurate even if
+## the model tensor is ever stored in half precision.
+l1_distance = cp.ReductionKernel(
+    'T m, T c',                       ## in_params
+    'float32 err',                    ## out_params
+    'fabsf((float)m - (float)c)',     ## map, upcast before subtracting
+    'a + b',                          ## reduce, accumulated in float32
+    'err = a',                        ## post-reduction map
+    '0',                              ## identity
+    'l1_distance'                     ## kernel name
+)
+
+## Fused pre-convolution input for the FDG models. A single kernel writes
+## theta1 * exp(-alpha1 * Ti) + theta2 * exp(-alpha2 * Ti) straight into the
+## output, instead of a chain of CuPy temporaries (two exponential grids,
+## two products and a sum, each a full (1, S, finer_t_size) allocation).
+fdg_input = cp.ElementwiseKernel(
+    'T t1, T a1, T t2, T a2, T Ti',                    ## in_params
+    'T out',                                           ## out_params
+    'out = t1 * exp(-a1 * Ti) + t2 * exp(-a2 * Ti)',   ## operation
+    'fdg_input'                                        ## kernel name
+)
+
+def extract_values(df):
+    """
+    Extracts the values from the given DataFrame.
+
+    Args:
+        df (pd.DataFrame): Input DataFrame.
+
+    Returns:
+        tuple: A tuple containing the extracted values.
+            Each has a shape of (num_time_frame).
+    """
+    time_frame_size = cp.array(df.iloc[:, 0]).astype(cp.float32)
+    Ti = cp.array(df.iloc[:, 1].values).astype(cp.float32)
+    Cb = cp.array(df.iloc[:, 2].values).astype(cp.float32)
+
+    return time_frame_size, Cb, Ti
+
+def rechunk_input_hdf5(path_data, chunk_size):
+    """
+    Rewrites a pandas-written input HDF5 into a column-chunked layout that
+        matches the voxel-chunk access pattern. pd.to_hdf stores the table
+        row-oriented, so slicing a column slab forces the HDF5 library to
+        read and decompress the whole file for every chunk. A one-time
+        rewrite into a dataset chunked as (num_time_frame, chunk_size)
+        makes each voxel chunk a single contiguous read.
+
+    Args:
+        path_data (str): Path to the pandas-written input HDF5.
+        chunk_size (int): Number of voxels read per chunk. None falls 
+            back to a generic column chunk of 256.
+
+    Returns:
+        str: Path of the rechunked file.
+    """
+    root, ext = os.path.splitext(path_data)
+    path_rechunked = root + "_rechunked" + (ext or ".h5")
+    if os.path.exists(path_rechunked):
+        return path_rechunked ## already converted by an earlier run
+
+    values = pd.read_hdf(path_data, "df").values.astype(np.float32)
+    with h5py.File(path_rechunked, "w") as f:
+        f.create_dataset("TACs", 
+                         data = values, 
+                         chunks = (values.shape[0], 
+                                   min(chunk_size or 256, values.shape[1])), 
+                         compression = "gzip", 
+                         compression_opts = 3)
+
+    return path_rechunked
+
+def pin_host_array(array):
+    """
+    Copies a host array into page-locked (pinned) memory, so that H2D
+    transfers can run asynchronously on a CUDA stream.
+
+    Args:
+        array (np.ndarray): Host array to stage.
+
+    Returns:
+        np.ndarray: A pinned copy of the input array.
+    """
+    pinned = np.frombuffer(
+        cp.cuda.alloc_pinned_memory(array.nbytes), 
+        array.dtype, 
+        array.size
+        ).reshape(array.shape)
+    pinned[...] = array
+
+    return pinned
+
+def extract_TAC_chunks(source, index, chunk_size, num_voxel, stream=None):
+    """
+    Extracts chunks of TAC (Time-Activity Curve) from the given source.
+    Chunks are used so that only a proportion of the data is loaded into memory 
+        at a time, preventing memory overflow.
+
+    Args:
+        source (pd.DataFrame, h5py.Dataset or str): Input DataFrame, a 
+            column-chunked HDF5 dataset (see rechunk_input_hdf5), or the 
+            path of the input csv. For a dataset or a path, only the 
+            chunk's columns are read, so the full voxel matrix never has 
+            to sit in host RAM.
+        index (int): Starting index of the chunk.
+        chunk_size (int): Size of each chunk.
+        num_voxel (int): Number of voxels.
+        stream (cp.cuda.Stream): Optional stream for the upload. When given, 
+            the copy is issued asynchronously on it and the chunk is staged 
+            through pinned memory, so it can overlap GPU compute.
+
+    Returns:
+        cp.ndarray: Extracted TAC chunks, shaped as (num_time_frame, num_voxel).
+            When a stream is given, a (chunk, pinned_buffer) tuple is returned
+            instead; the pinned buffer must be kept alive until the stream is
+            synchronised.
+    """
+    if isinstance(source, str):
+        df_column_size = pd.read_csv(source, nrows = 0).shape[1]
+        ## only the header line is parsed to get the column count
+    else:
+        df_column_size = source.shape[1]
+    num_of_other_columns = 3 ## 3 columns are for time_frame_size, Cb, and Ti
+    if num_voxel is None: ## When None, use all voxels
+        num_voxel = df_column_size - num_of_other_columns
+    chunk_end = min(index + chunk_size, df_column_size, num_voxel + num_of_other_columns)
+    if isinstance(source, str):
+        values = pd.read_csv(source, 
+                             usecols = range(index, chunk_end), 
+                             dtype = np.float32).values
+    elif isinstance(source, pd.DataFrame):
+        values = source.iloc[:, index: chunk_end].values.astype(np.float32)
+    else: ## column-chunked h5py dataset, one contiguous read per chunk
+        values = source[:, index: chunk_end].astype(np.float32)
+    if stream is None:
+        return cp.array(values)
+
+    pinned = pin_host_array(values)
+    Ct = cp.empty(pinned.shape, dtype = cp.float32)
+    Ct.set(pinned, stream = stream)
+
+    return Ct, pinned
+
+def output_file_init(path_output_para, path_output_model, write_paras, output_compressed):
+    """
+    Initializes the output files for parameter and model data, so that results
+        can be recorded in chunks.
+
+    Args:
+        path_output_para (str): Path to the parameter output file.
+        path_output_model (str): Path to the model output file.
+        write_paras (bool): flag indicating whether to write parameter posterior.
+        output_compressed (bool): flag indicating whether to compress the output 
+                                  posteriors (hdf5/csv).
+    """
+    para_columns = ["Voxel_No", "V_b", "K_1", "k_2", 
+                    "k_3", "k_4", "K_b", "V_T", "model"]
+    num_of_columns = len(para_columns)
+    model_p_columns = ["Voxel_No", "model", "probability_of_model"]
+
+    if write_paras:
+        if output_compressed:
+            with h5py.File(path_output_para, "w") as f:
+                ds = f.create_dataset("parameters", 
+                                      shape = (0, num_of_columns), 
+                                      maxshape = (None, num_of_columns), 
+                                      chunks = True, 
+                                      compression = "lzf", 
+                                      dtype = "f4")
+                ## a single extendable dataset instead of one pytables key
+                ## per chunk; appends are cheap chunked writes with no
+                ## float-to-text conversion
+                ds.attrs["columns"] = para_columns
+                ds.attrs["model_names"] = MODEL_NAMES
+                ## the model column holds the numeric code; the mapping to
+                ## names is recorded alongside
+        else:
+            with open(path_output_para, "w") as f:
+                f.write(",".join(para_columns) + "\n")
+            ## just the header line; the typed rows follow in
+            ## write_csv_chunks
+
+    if output_compressed:
+        with h5py.File(path_output_model, "w") as f:
+            ds = f.create_dataset("model_probabilities", 
+                                  shape = (0, len(model_p_columns)), 
+                                  maxshape = (None, len(model_p_columns)), 
+                                  chunks = True, 
+                                  compression = "gzip", 
+                                  compression_opts = 3, 
+                                  dtype = "f4")
+            ## the model posterior streams straight into one extendable
+            ## dataset; no more temporary csv that had to be re-read and
+            ## rewritten as hdf5 at the end of the run
+            ds.attrs["columns"] = model_p_columns
+            ds.attrs["model_names"] = MODEL_NAMES
+    else:
+        model_p_df = pd.DataFrame(columns = model_p_columns)
+        model_p_df.to_csv(
+            path_output_model.replace("h5", "csv"), 
+            index = False, 
+            mode = "w", 
+            # compression = "xz"
+            )
+
+def output_dataframe(model_p):
+    """
+    Prepares the model probability posterior DataFrame. The parameter
+        posterior needs no preparation here any more: calculate_results
+        already assembles the final table on the GPU.
+
+    Args:
+        model_p (np.ndarray): Model data.
+
+    Returns:
+        pd.DataFrame: The model probability posterior DataFrame.
+    """
+    model_p_df = pd.DataFrame(model_p)
+    model_p_df[0] = model_p_df.iloc[:, 0].astype(int)
+    model_p_df[2] = model_p_df.iloc[:, 2].astype(float)
+    model_p_df.iloc[:, 2] = np.where(model_p_df.iloc[:, 1] == 1, 
+                                     1 - model_p_df.iloc[:, 2], 
+                                     model_p_df.iloc[:, 2])
+    ## the model column keeps its numeric code here; it becomes a name
+    ## only at the text boundary in write_csv_chunks
+
+    return model_p_df
+
+def write_csv_chunks(para, 
+                     model_p_df, 
+                     path_output_para, 
+                     path_output_model, 
+                     write_paras, 
+                     output_compressed):
+    """
+    Writes the parameter and model data to the output files in chunks.
+
+    Args:
+        para (np.ndarray): Parameter data, with the model column as its 
+            numeric code.
+        model_p_df (pd.DataFrame): Model data.
+        path_output_para (str): Path to the parameter output file.
+        path_output_model (str): Path to the model output file.
+        write_paras (bool): flag indicating whether to write parameter posterior.
+        output_compressed (bool): flag indicating whether to compress the output 
+                                  posteriors (hdf5/csv).
+    """
+    if write_paras:
+        if output_compressed:
+            rows = para.astype(np.float32)
+            with h5py.File(path_output_para, "a") as f:
+                ds = f["parameters"]
+                ds.resize(ds.shape[0] + rows.shape[0], axis = 0)
+                ds[-rows.shape[0]:] = rows
+        else:
+            rec = np.empty(para.shape[0], dtype = PARA_ROW_DTYPE)
+            rec[PARA_ROW_DTYPE.names[0]] = para[:, 0]
+            for i, name in enumerate(PARA_ROW_DTYPE.names[1:-1], start = 1):
+                rec[name] = para[:, i]
+            rec["model"] = np.asarray(MODEL_NAMES)[para[:, -1].astype(np.int64)]
+            ## one typed record block per chunk instead of three pandas
+            ## dtype cascades, each of which copied the whole block manager
+            with open(path_output_para, "a") as f:
+                np.savetxt(f, rec, fmt = PARA_ROW_FMT)
+
+    if output_compressed:
+        rows = model_p_df.to_numpy(dtype = np.float32)
+        with h5py.File(path_output_model, "a") as f:
+            ds = f["model_probabilities"]
+            ds.resize(ds.shape[0] + rows.shape[0], axis = 0)
+            ds[-rows.shape[0]:] = rows
+    else:
+        model_p_df.iloc[:, 1] = model_p_df.iloc[:, 1].astype(np.int64).map(
+            dict(enumerate(MODEL_NAMES))
+            ) ## the model code becomes its name only at the text boundary
+        model_p_df.to_csv(
+            path_output_model.replace("h5", "csv"), 
+            header = False, 
+            index = False, 
+            mode = "a", 
+            # compression = "xz"
+            )
+    
+def cumconv(a, b, time_frame_size):
+    """
+    Performs cumulative convolution of two arrays.
+
+    Args:
+        a (cp.ndarray): First array.
+        b (cp.ndarray): Second array.
+        time_frame_size (cp.ndarray): Time frame size.
+
+    Returns:
+        cp.ndarray: Result of the cumulative convolution, shaped as 
+            (1, num_prior_simulation_size, num_time_frame). The first dimension
+            is added to match the num_voxels.
+    """
+    num_time_frame = b.shape[-1]
+    n = next_fast_len(a.shape[-1] + b.shape[-1] - 1)
+    ## zero-padded length for a full linear convolution, rounded up to a
+    ## cuFFT-friendly size
+    A = cp.fft.rfft(a, n = n, axis = -1)
+    B = cp.fft.rfft(b, n = n, axis = -1)
+    ret = cp.fft.irfft(A * B, n = n, axis = -1)[..., :num_time_frame]
+    ## Only takes the first num_time_frame elements because of how the
+    ## convolution works. Everything stays on the GPU, so there is no
+    ## host round-trip any more.
+    ret *= time_frame_size ## in-place to avoid an extra allocation
+
+    return ret
+
+def get_FDG_Ct(time_frame_size, Cb, Ca, Ti, paras):
+    """
+    Generates FDG (Fluorodeoxyglucose) model TACs using simulated priors.
+
+    Args:
+        time_frame_size (cp.ndarray): Time frame size.
+        Cb (cp.ndarray): Cb values.
+        Ca (cp.ndarray): Ca values.
+        Ti (cp.ndarray): Ti values.
+        paras (cp.ndarray): Kinetic parameter values. The model flag is 
+            kept as a separate array and is only needed at acceptance time, 
+            so it no longer rides along in this broadcast.
+
+    Returns:
+        cp.ndarray: FDG model TACs, shaped as the return value of cumconv.
+    """
+    Vb, alpha1, alpha2, theta1, theta2, Kb = [row for row in paras]
+    Cb_cumsum = cp.cumsum(Cb, axis = -1)
+
+    Ct = cumconv(fdg_input(theta1, alpha1, theta2, alpha2, Ti), 
+                 Ca, time_frame_size) + Vb * Cb + Vb * Kb * Cb_cumsum * time_frame_size
+
+    return Ct
+
+def generate_FDG_models(time_frame_size, Cb, Ca, Ti, par_mat, finer_t_size):
+    """
+    A wrapper function to generate FDG models using the given parameters,
+    including fitting the input function for minimal convolution error.
+
+    Args:
+        time_frame_size (cp.ndarray): Time frame size.
+        Cb (cp.ndarray): Cb values.
+        Ca (cp.ndarray): Ca values.
+        Ti (cp.ndarray): Ti values.
+        par_mat (cp.ndarray): Parameter matrix.
+        finer_t_size (int): Finer time frame size for smaller convolution error.
+
+    Returns:
+        cp.ndarray: FDG model TACs using the prior simulations.
+    """
+    ## Fit the input function, and get the finer time frame
+    ## for smaller convolution error
+    input_function_args = fit_input_function(Ti, Cb)
+    Ti, time_frame_size, original_Ti_indices = get_finer_time_frame(Ti, finer_t_size)
+    Cb = input_function(Ti, *input_function_args)
+    Ca = Cb
+    print("Input function fitted...")
+
+    time_frame_size = cp.asarray(time_frame_size, dtype = cp.float32)[None, None, :]
+    Ca = cp.asarray(Ca, dtype = cp.float32)[None, None, :]
+    Cb = cp.asarray(Cb, dtype = cp.float32)[None, None, :]
+    Ti = cp.asarray(Ti, dtype = cp.float32)[None, None, :]
+    ## shape (1, 1, num_time_frame)
+    ## to match (num_vox, num_prior_simulation_size, num_time_frame)
+    paras = cp.asarray(par_mat.T, dtype = cp.float32)[:, None, :, None]
+    ## shape (num_variable, 1, num_prior_simulation_size, 1)
+    ## to match (num_variable, num_vox, num_prior_simulation_size, num_time_frame)
+    ## every operand is pinned to float32 here: the fused input kernel
+    ## binds them all to one type placeholder, and the priors arrive as
+    ## float64 while the refined grid's dtype depends on the numpy
+    ## promotion rules in effect, so nothing is left to chance
+
+    M = get_FDG_Ct(time_frame_size, Cb, Ca, Ti, paras)
+    M = M[..., original_Ti_indices]
+
+    print("Models generated...")
+
+    return M
+
+def distance_function(M, Ct, distance_type, validation_mode=False, 
+                      hyperparameter=None):
+    """
+    Calculates the distance function between the model and the observed data.
+    
+    Args:
+        M (cp.ndarray): FDG model TACs using the prior simulations.
+            (num_vox, num_prior_simulation_size, num_time_frame)
+        Ct (cp.ndarray): TAC chunks.
+            (num_vox, 1, num_time_frame)
+        distance_type (str): Type of distance function to use. Options are:
+            "L1", "L2", "Cauchy", "Huber", "Welsch", "CvM".
+            L1: L1 distance. L1 norm is the sum of the absolute values of the 
+                             vector.
+            L2: L2 distance. L2 norm is the square root of the sum of the 
+                             squared values of the vector.
+            Cauchy: Cauchy distance. Cauchy loss is the sum of the logarithm of 
+                                     1 plus the square of the vector divided by 
+                                     gamma.
+            Huber: Huber distance. Huber loss is the convolution of the absolute
+                                   value function with the rectangular function,
+                                   scaled and translated.
+            Welsch: Welsch distance. Welsch loss is the sum of 1 minus the 
+                                     exponential of the square of the vector 
+                                     divided by gamma.
+            CvM: Cramer-von Mises distance. CvM norm is the sum of the square of
+                                            the ranks of the vector.
+        validation_mode (bool): flag indicating whether to use validation mode.
+        hyperparameter (float): Hyperparameter value for the distance function.
+            Tunable.
+
+    Returns:
+        cp.ndarray: Errors calculated using the given distance function.
+    """
+    if distance_type == "L1":
+        errors = l1_distance(M, Ct, axis = -1)
+    elif distance_type == "L2":
+        errors = cp.sum(cp.square(M - Ct), axis = -1)
+    elif distance_type == "Cauchy":
+        gamma = hyperparameter if validation_mode else 19320.175439
+        errors = cp.sum(cp.log(1 + cp.square((M - Ct) / gamma)), axis = -1)
+    elif distance_type == "Huber":
+        delta = hyperparameter if validation_mode else 10925.438596
+        errors = cp.sum(cp.where(cp.abs(M - Ct) <= delta, 
+                                 0.5 * cp.square(M - Ct), 
+                                 delta * (cp.abs(M - Ct) - 0.5 * delta)), 
+                        axis = -1)
+    elif distance_type == "Welsch":
+        gamma = hyperparameter if validation_mode else 19701.754386
+        errors = cp.sum(1 - cp.exp(-cp.square((M - Ct) / gamma)), axis = -1)
+    elif distance_type == "CvM":
+        M_sorted = cp.sort(M, axis = -1)
+        Ct_sorted = cp.sort(Ct, axis = -1)
+        shape = (Ct_sorted.shape[0], M_sorted.shape[1], M_sorted.shape[2])
+        M_sorted = cp.broadcast_to(M_sorted, shape)
+        Ct_sorted = cp.broadcast_to(Ct_sorted, shape)
+        combined_sorted = cp.sort(
+            cp.concatenate((M_sorted, Ct_sorted), axis = -1), 
+            axis = -1
+            )
+        ranks_M = cp.sum(
+            combined_sorted[..., None, :] < M_sorted[..., None], 
+            axis = -1
+        )
+        ranks_Ct = cp.sum(
+            combined_sorted[..., None, :] < Ct_sorted[..., None],
+            axis = -1
+        )
+        M = M.shape[-1]
+        N = Ct.shape[-1]
+        i_list = cp.arange(M)
+        j_list = cp.arange(N)
+        U = M * cp.sum(cp.square(ranks_M - i_list), axis = -1) + \
+            N * cp.sum(cp.square(ranks_Ct - j_list), axis = -1)
+        errors = U / (M * N * (M + N)) - (4 * M * N - 1) / (6 * (M + N))
+        errors = errors + cp.random.normal(0, 0.0001, errors.shape)
+    else:
+        return distance_function(M, Ct, "L1")
+
+    return errors
+
+def chunk_device_results(M, par_mat, model, Ct, S, thresh, write_paras, 
+                         model_0_prob_thres=0.5, distance_type="L1", 
+                         validation_mode=False, hyperparameter=None):
+    """
+    Device-side core of calculate_results: distance reduction, acceptance, 
+        and the parameter transform, with no host transfers and no host-
+        dependent values. Keeping this free of synchronisation points is 
+        what allows vABC to capture it into a CUDA graph and replay it for 
+        every chunk.
+
+    Args:
+        M (cp.ndarray): FDG model TACs using the prior simulations.
+            (num_vox, num_prior_simulation_size, num_time_frame)
+        par_mat (cp.ndarray): Kinetic parameter matrix.
+            (num_prior_simulation_size, num_variable)
+        model (cp.ndarray): Model flag prior draws.
+            (num_prior_simulation_size,)
+        Ct (cp.ndarray): TAC chunks, already transposed to 
+            (num_vox, 1, num_time_frame).
+        S (int): Prior simulation size. i.e. num_prior_simulation_size
+        thresh (float): Threshold value for acceptance. Tunable.
+        write_paras (bool): flag indicating whether to write parameter posterior.
+        model_0_prob_thres (float): Threshold for model 0 probability. Tunable.
+        distance_type (str): Type of distance function to use. Options are:
+            "L1", "L2", "Cauchy", "Huber", "Welsch", "CvM".
+        validation_mode (bool): flag indicating whether to use validation mode.
+        hyperparameter (float): Hyperparameter value for the distance function.
+            Tunable.
+
+    Returns:
+        tuple: The (accepted, models, percentage_zeros) device arrays, where
+            accepted is the transformed parameter table without the voxel
+            number column (None when write_paras is False).
+    """
+    num_variable = 6
+
+    errors = distance_function(
+        M, 
+        Ct, 
+        distance_type = distance_type, 
+        validation_mode = validation_mode, 
+        hyperparameter = hyperparameter
+        )
+    ## calculate errors along time_frame axis
+    ## (num_vox, num_prior_simulation_size)
+    accepted_size = max(1, int(round(S * thresh)))
+    ## fixed acceptance count per voxel: the accepted_size smallest errors.
+    ## argpartition only partially sorts (O(S) instead of O(S log S)) and
+    ## breaks ties by position, so every voxel accepts exactly the same
+    ## number of simulations regardless of the distance function used.
+    ## This also removes the old risk of ties producing ragged acceptance
+    ## sizes and breaking the vectorisation.
+    accepted_indices = cp.argpartition(errors, accepted_size, 
+                                       axis = -1)[:, :accepted_size]
+    ## (num_vox, accepted_size)
+    accepted = par_mat[accepted_indices]
+    ## fancy indexing gathers the accepted rows for each voxel directly, 
+    ## without repeating par_mat per voxel first
+    ## (num_vox, accepted_size, num_variable)
+
+    accepted_models = model[accepted_indices] ## (num_vox, accepted_size)
+                                               ## models accepted for each voxel
+    percentage_zeros = cp.mean(accepted_models == 0, axis = -1)
+    ## along accepted_size axis
+    models = (percentage_zeros < model_0_prob_thres).astype(cp.int32)
+
+    if write_paras:
+        num_vox = accepted.shape[0]
+        accepted = accepted.reshape(num_vox * accepted_size, num_variable)
+        ## We have alpha1 alpha2 theta1 theta2; we need K_1 k_2 k_3 k_4.
+        ## Doing the algebra here keeps it on the GPU, so the host only
+        ## ever receives the finished table.
+        V_b = accepted[:, 0]
+        alpha1 = accepted[:, 1]
+        alpha2 = accepted[:, 2]
+        theta1 = accepted[:, 3]
+        theta2 = accepted[:, 4]
+        K_b = accepted[:, 5]
+        model_codes = accepted_models.reshape(num_vox * accepted_size)
+
+        K_1 = (theta1 + theta2) / (1 - V_b)
+        k_2 = (theta1 * alpha1 + theta2 * alpha2) / (theta1 + theta2)
+        k_4 = alpha1 * alpha2 / k_2
+        k_3 = alpha1 + alpha2 - k_2 - k_4
+        V_T = K_1 / k_2 * (1 + k_3 / k_4)
+        # K_i = K_1 * k_3 / (k_2 + k_3)
+
+        accepted = cp.column_stack((V_b, K_1, k_2, k_3, k_4, K_b, V_T, 
+                                    model_codes))
+    else:
+        accepted = None
+
+    return accepted, models, percentage_zeros
+
+def calculate_results(M, par_mat, model, Ct, S, thresh, write_paras, 
+                      model_0_prob_thres=0.5, vox_num_start=0, 
+                      distance_type="L1", validation_mode=False, 
+                      hyperparameter=None, device_results=None, 
+                      host_buffers=None):
+    """
+    Calculates the accepted simulations based on the given inputs.
+
+    Args:
+        M (cp.ndarray): FDG model TACs using the prior simulations.
+            (num_vox, num_prior_simulation_size, num_time_frame)
+        par_mat (cp.ndarray): Kinetic parameter matrix.
+            (num_prior_simulation_size, num_variable)
+        model (cp.ndarray): Model flag prior draws.
+            (num_prior_simulation_size,)
+        Ct (cp.ndarray): TAC chunks.
+            (num_time_frame, num_vox)
+        S (int): Prior simulation size. i.e. num_prior_simulation_size
+        thresh (float): Threshold value for acceptance. Tunable.
+        write_paras (bool): flag indicating whether to write parameter posterior.
+        model_0_prob_thres (float): Threshold for model 0 probability. Tunable.
+        vox_num_start (int): Starting voxel number. For batching purpose.
+        distance_type (str): Type of distance function to use. Options are:
+            "L1", "L2", "Cauchy", "Huber", "Welsch", "CvM".
+        validation_mode (bool): flag indicating whether to use validation mode.
+        hyperparameter (float): Hyperparameter value for the distance function.
+            Tunable.
+        device_results (tuple): Optional precomputed output of 
+            chunk_device_results, e.g. from a CUDA graph replay. When given, 
+            the device-side pipeline is skipped and only the voxel numbering 
+            and the host transfers are performed here.
+        host_buffers (tuple): Optional persistent pinned (para_host, 
+            model_p_host) numpy arrays reused across chunks; when given, the 
+            returned host results are views into them.
+
+    Returns:
+        tuple: A tuple containing the accepted parameter posteriors and model 
+            probabilities.
+    """
+    num_vox = Ct.shape[-1]
+
+    para_host = model_p_host = None
+    if host_buffers is not None:
+        para_host, model_p_host = host_buffers
+
+    voxel_numbers = cp.arange(num_vox) + vox_num_start
+
+    if device_results is None:
+        device_results = chunk_device_results(
+            M, 
+            par_mat, 
+            model, 
+            Ct.T[:, None, :], ## (num_vox, 1, num_time_frame), second 
+                              ## dimension for broadcasting
+            S, 
+            thresh, 
+            write_paras, 
+            model_0_prob_thres, 
+            distance_type = distance_type, 
+            validation_mode = validation_mode, 
+            hyperparameter = hyperparameter
+            )
+    accepted, models, percentage_zeros = device_results
+
+    model_p = cp.column_stack((voxel_numbers, models, percentage_zeros))
+    if model_p_host is not None:
+        model_p_out = model_p_host[:num_vox]
+        model_p.get(out = model_p_out)
+        ## lands in the persistent pinned buffer instead of a fresh
+        ## pageable allocation, so the copy needs no driver-side staging
+        model_p = model_p_out
+    else:
+        model_p = model_p.get()
+
+    if write_paras:
+        accepted_size = max(1, int(round(S * thresh)))
+        voxel_numbers = voxel_numbers.repeat(accepted_size)
+        accepted = cp.column_stack((voxel_numbers, accepted))
+        if para_host is not None:
+            para_out = para_host[:accepted.shape[0]]
+            accepted.get(out = para_out)
+            accepted = para_out
+        else:
+            accepted = accepted.get()
+    else:
+        accepted = None
+
+    return accepted, model_p
+
+def input_function(t, beta_1, beta_2, beta_3, kappa_1, kappa_2, kappa_3):
+    """
+    Calculates the input function using the given parameters.
+
+    Args:
+        t (cp.ndarray): Time values.
+        beta_1 (cp.ndarray): beta_1 values.
+        beta_2 (cp.ndarray): beta_2 values.
+        beta_3 (cp.ndarray): beta_3 values.
+        kappa_1 (cp.ndarray): kappa_1 values.
+        kappa_2 (cp.ndarray): kappa_2 values.
+        kappa_3 (cp.ndarray): kappa_3 values.
+
+    Returns:
+        cp.ndarray: Input function values.
+    """
+    ## initial injection time
+    return (beta_1 * t - beta_2 - beta_3) * np.exp(-kappa_1 * t) \
+        + beta_2 * np.exp(-kappa_2 * t) + beta_3 * np.exp(-kappa_3 * t)
+
+def fit_input_function(Ti, Cb):
+    """
+    Fits the input function using the given parameters.
+
+    Args:
+        Ti (cp.ndarray): Time values.
+        Cb (cp.ndarray): whole blood radioactivity concentration values.
+
+    Returns:
+        tuple: A tuple containing the fitted parameters.
+    """
+    Ti_vec = cp.array(Ti)[None, :]
+    chosen_TAC_vec = cp.array(Cb)[None, :]
+
+    cp.random.seed(2024)
+    S = 10000000
+    thresh = 0.001
+
+    beta_1 = cp.random.uniform(150000, 700000, S)[:, None]
+    beta_2 = cp.random.uniform(0, 3000, S)[:, None]
+    beta_3 = cp.random.uniform(0, 3000, S)[:, None]
+    kappa_1 = cp.random.uniform(3, 10, S)[:, None]
+    kappa_2 = cp.random.uniform(0, 0.075, S)[:, None]
+    kappa_3 = cp.random.uniform(0, 0.075, S)[:, None]
+    error = cp.zeros(S)
+
+    # for i in tqdm(range(S)):
+    lambda_coef = 30
+    TACs = input_function(Ti_vec, beta_1, beta_2, beta_3, kappa_1, kappa_2, kappa_3)
+    error = cp.sum(cp.abs(chosen_TAC_vec - TACs), axis = -1) + \
+        lambda_coef * cp.abs(chosen_TAC_vec - TACs)[:, 2]
+    # Filter the best threshold quantile
+    k = max(1, int(round(S * thresh)))
+    threshold = cp.partition(error, k)[k]
+    ## partition places the (k+1)-th smallest error at position k without
+    ## fully sorting all S errors the way cp.quantile does; only the
+    ## threshold value itself is needed here
+    filtered_indices = cp.where(error <= threshold)
+
+    # Filter the parameters
+    filtered_beta_1 = beta_1[filtered_indices].flatten()
+    filtered_beta_2 = beta_2[filtered_indices].flatten()
+    filtered_beta_3 = beta_3[filtered_indices].flatten()
+    filtered_kappa_1 = kappa_1[filtered_indices].flatten()
+    filtered_kappa_2 = kappa_2[filtered_indices].flatten()
+    filtered_kappa_3 = kappa_3[filtered_indices].flatten()
+
+    beta_1 = cp.median(filtered_beta_1)
+    beta_2 = cp.median(filtered_beta_2)
+    beta_3 = cp.median(filtered_beta_3)
+    kappa_1 = cp.median(filtered_kappa_1)
+    kappa_2 = cp.median(filtered_kappa_2)
+    kappa_3 = cp.median(filtered_kappa_3)
+
+    return beta_1, beta_2, beta_3, kappa_1, kappa_2, kappa_3
+
+def get_finer_time_frame(Ti, finer_t_size):
+    """
+    Gets the finer time frame for smaller convolution error.
+
+    Args:
+        Ti (cp.ndarray): Time values.
+        finer_t_size (int): Finer time frame size.
+
+    Returns:
+        cp.ndarray: Finer time frame values.
+    """
+    Ti = cp.array(Ti)
+    finer_t = cp.linspace(Ti[0], Ti[-1], finer_t_size)
+    # finer_t = cp.unique(cp.concatenate((Ti, finer_t))) ## needs to be uniform
+    frame_size = cp.concatenate((cp.array([0]), cp.diff(finer_t)))
+    original_Ti_indices = cp.searchsorted(finer_t, Ti)
+
+    return finer_t, frame_size, original_Ti_indices
+
+def vABC(num_voxel, path_data, path_output_para, path_output_model, par_mat, 
+         model, S, thresh, model_0_prob_thres, write_paras, input_compressed=False, 
+         output_compressed=False, chunk_size=None, finer_t_size=1000, 
+         distance_type="L1", validation_mode=False, hyperparameter=None, 
+         use_cuda_graph=False):
+    """
+    Performs the vABC (Variational Approximate Bayesian Computation) algorithm.
+
+    Args:
+        num_voxel (int): Number of voxels to process. If None, all voxels are
+        path_data (str): Path to the input data file.
+        path_output_para (str): Path to the parameter posterior output file.
+        path_output_model (str): Path to the model probability posterior output file.
+        par_mat (cp.ndarray): Kinetic parameter matrix, size 
+            (num_prior_simulation_size, num_variable). The model flag is not 
+            part of it, so the broadcast model tensor never carries it.
+        model (cp.ndarray): Model flag prior draws, size (num_prior_simulation_size,).
+        S (int): Size of the simulation. i.e. num_prior_simulation_size
+        thresh (float): Threshold value for acceptance. Tunable.
+        model_0_prob_thres (float): Threshold for model 0 probability. Tunable.
+        write_paras (bool): flag indicating whether to write parameter posterior.
+        input_compressed (bool): flag indicating whether the input data is compressed (hdf5/csv).
+        output_compressed (bool): flag indicating whether to compress the output 
+                                  posteriors (hdf5/csv).
+        chunk_size (int): Size of each chunk. Used to prevent memory 
+            overflow. When None, the largest batch that fits in free GPU 
+            memory (with headroom) is probed at start-up.
+        finer_t_size (int): Finer time frame size for smaller convolution error.
+        distance_type (str): Type of distance function to use. Options are:
+            "L1", "L2", "Cauchy", "Huber", "Welsch", "CvM".
+        validation_mode (bool): flag indicating whether to use validation mode.
+        hyperparameter (float): Hyperparameter value for the distance function.
+            Tunable.
+        use_cuda_graph (bool): flag indicating whether to capture the per-chunk 
+            device pipeline into a CUDA graph and replay it, amortising kernel 
+            launch latency. Falls back to eager execution for the CvM distance 
+            (host-side randomness) and for a ragged final chunk.
+    """
+    if use_cuda_graph:
+        global MEMORY_POOL
+        MEMORY_POOL = cp.get_default_memory_pool()
+        cp.cuda.set_allocator(MEMORY_POOL.malloc)
+        ## stream capture replays into the very blocks reserved at
+        ## capture time; only the caching pool guarantees they stay put,
+        ## so the graph path overrides the stream-ordered allocator that
+        ## main may have installed
+
+    if input_compressed:
+        hdf5_file = h5py.File(path_data, "r")
+        if "TACs" not in hdf5_file: ## pandas-written, row-oriented layout
+            hdf5_file.close()
+            print("Rechunking the input HDF5 column-wise...")
+            path_data = rechunk_input_hdf5(path_data, chunk_size)
+            hdf5_file = h5py.File(path_data, "r")
+        TAC_source = hdf5_file["TACs"]
+        df_column_size = TAC_source.shape[1] ## number of columns in the input
+        df = pd.DataFrame(TAC_source[:, :3])
+        ## extract_values only needs the three metadata columns
+    else:
+        df = pd.read_csv(path_data, usecols = range(3))
+        ## only time_frame_size, Ti, and Cb stay resident in host RAM; the
+        ## voxel columns are parsed lazily, one chunk at a time. Re-parsing
+        ## costs some CPU per chunk but keeps startup instant and the host
+        ## footprint flat regardless of study size.
+        TAC_source = path_data
+        df_column_size = pd.read_csv(path_data, nrows = 0).shape[1]
+    time_frame_size, Cb, Ti = extract_values(df)
+    Ca = Cb ## as a part of our hypothesis
+    print("Data extracted...")
+
+    if chunk_size is None:
+        free = cp.cuda.runtime.memGetInfo()[0]
+        num_time_frame = len(Ti)
+        if distance_type == "L1":
+            bytes_per_voxel = S * 4 * 6
+            ## the fused L1 reduction never materialises the difference
+            ## tensor: per voxel only the float32 error row, the int64
+            ## argpartition indices and their workspace remain, all of
+            ## length S; six 4-byte words per simulation is a safe bound
+        elif distance_type == "CvM":
+            bytes_per_voxel = S * num_time_frame * (4 * num_time_frame + 16)
+            ## the rank comparisons broadcast boolean tensors of shape
+            ## (num_vox, S, num_time_frame, 2 * num_time_frame), so the
+            ## budget grows with the square of the number of time frames
+        else:
+            bytes_per_voxel = S * (num_time_frame * 6 + 6) * 4
+            ## L2/Cauchy/Huber/Welsch still materialise the broadcast
+            ## (num_vox, S, num_time_frame) difference tensor plus
+            ## temporaries of the same shape on top of the error row
+        chunk_size = max(1, int(0.6 * free / bytes_per_voxel))
+        ## 40% of free memory stays as headroom for the model tensor and
+        ## the pool's transients
+        if num_voxel is not None:
+            chunk_size = max(1, min(chunk_size, num_voxel))
+        print(f"Adaptive chunk size: {chunk_size} voxels per batch")
+
+    M = None
+    if validation_mode:
+    ## If validation mode is on, try to load the models to save computation time
+        try:
+            M = cp.load("generated_models.npz")["M"]
+            print("Models loaded...")
+        except FileNotFoundError:
+            pass
+    if M is None:
+        M = generate_FDG_models(
+            time_frame_size, Cb, Ca, Ti, par_mat, finer_t_size
+        )
+        cp.savez_compressed("generated_models", M = M)
+    M = cp.asarray(M, dtype = cp.float32)
+    ## the fused distance kernel binds M and Ct to a single type
+    ## placeholder, and CuPy does not implicitly cast user-kernel
+    ## arguments, so M must actually be float32 - whether it was just
+    ## generated in float64 or loaded from an older cache; halving the
+    ## resident model tensor is welcome anyway
+    MEMORY_POOL.free_all_blocks()
+    ## release the temporaries left behind by the model generation
+
+    index = 3 ## ignoring the first 3 columns
+              ## which are for time_frame_size, Cb, and Ti
+
+    output_file_init(
+        path_output_para, 
+        path_output_model, 
+        write_paras, 
+        output_compressed
+        )
+    ## initialise the output files
+    print("Output files initialised...")
+
+    if num_voxel is None: ## When None, use all voxels
+        num_voxel = df_column_size - 3
+
+    # Calculate the number of iterations needed for the tqdm progress bar
+    total_iterations = min(num_voxel, df_column_size - 3) / chunk_size
+    total_iterations = int(total_iterations) if total_iterations.is_integer() else int(total_iterations) + 1
+
+    accepted_size = max(1, int(round(S * thresh)))
+    model_p_host = pin_host_array(np.empty((chunk_size, 3)))
+    para_host = None
+    if write_paras:
+        para_host = pin_host_array(
+            np.empty((chunk_size * accepted_size, len(PARA_ROW_DTYPE.names)))
+            )
+    ## persistent pinned landing buffers for the per-chunk device-to-host
+    ## copies: a page-locked destination lets the copy engine run at full
+    ## bandwidth, and nothing is reallocated between chunks
+
+    cp.cuda.set_pinned_memory_allocator(cp.cuda.PinnedMemoryPool().malloc)
+    ## staging buffers come from a pinned pool, so uploads are truly async
+    copy_stream = cp.cuda.Stream(non_blocking = True)
+    ## dedicated stream so the next chunk's H2D upload can overlap the
+    ## current chunk's kernels on the default stream
+    prefetched = extract_TAC_chunks(TAC_source, index, chunk_size, num_voxel, 
+                                    stream = copy_stream)
+
+    chunk_graph = None
+    graph_outputs = None
+    Ct_buffer = None
+    graph_stream = cp.cuda.Stream(non_blocking = True)
+    fill_done = cp.cuda.Event()
+    ## the per-chunk device pipeline has a fixed shape for every full chunk, 
+    ## so it can be captured once into a CUDA graph and replayed, collapsing 
+    ## its many small kernel launches into a single one per chunk
+
+    for _ in tqdm(range(total_iterations)):
+        ## batching to prevent memory overflow
+        if index >= df_column_size or index >= num_voxel + 3:
+            break
+
+        copy_stream.synchronize() ## make sure the upload has landed
+        Ct, pinned_buffer = prefetched
+        next_index = index + chunk_size
+        if next_index < df_column_size and next_index < num_voxel + 3:
+            prefetched = extract_TAC_chunks(TAC_source, next_index, chunk_size, 
+                                            num_voxel, stream = copy_stream)
+        ## the following chunk now uploads while this one computes
+
+        device_results = None
+        if use_cuda_graph and distance_type != "CvM" \
+                and Ct.shape[-1] == chunk_size:
+            if chunk_graph is None:
+                Ct_buffer = cp.empty((chunk_size, 1, Ct.shape[0]), 
+                                     dtype = cp.float32)
+                Ct_buffer[...] = Ct.T[:, None, :]
+                chunk_device_results(M, par_mat, model, Ct_buffer, S, thresh, 
+                                     write_paras, model_0_prob_thres, 
+                                     distance_type = distance_type, 
+                                     validation_mode = validation_mode, 
+                                     hyperparameter = hyperparameter)
+                ## warm-up call, so kernel compilation and pool growth happen 
+                ## outside the capture
+                with graph_stream:
+                    graph_stream.begin_capture()
+                    graph_outputs = chunk_device_results(
+                        M, par_mat, model, Ct_buffer, S, thresh, write_paras, 
+                        model_0_prob_thres, 
+                        distance_type = distance_type, 
+                        validation_mode = validation_mode, 
+                        hyperparameter = hyperparameter
+                        )
+                    chunk_graph = graph_stream.end_capture()
+            else:
+                Ct_buffer[...] = Ct.T[:, None, :]
+            fill_done.record()
+            graph_stream.wait_event(fill_done)
+            ## the buffer fill above runs on the legacy default stream,
+            ## which a non-blocking stream never implicitly waits for;
+            ## the event orders the replay after the copy has landed
+            with graph_stream:
+                chunk_graph.launch()
+            graph_stream.synchronize()
+            device_results = graph_outputs
+            ## every replay rewrites the captured output arrays in place
+
+        para, model_p = calculate_results(M, par_mat, model, Ct, S, thresh, 
+                                          write_paras, model_0_prob_thres, 
+                                          index - 3, 
+                                          distance_type = distance_type, 
+                                          validation_mode = validation_mode, 
+                                          hyperparameter = hyperparameter, 
+                                          device_results = device_results, 
+                                          host_buffers = (para_host, 
+                                                          model_p_host))
+        model_p_df = output_dataframe(model_p)
+        write_csv_chunks(para, model_p_df, path_output_para, path_output_model, 
+                         write_paras, output_compressed)
+
+        del Ct, pinned_buffer, para, model_p, model_p_df
+        if not use_cuda_graph:
+            MEMORY_POOL.free_all_blocks()
+            ## neither pool returns blocks to the driver eagerly on its own;
+            ## releasing each chunk's transients keeps the memory ceiling flat
+            ## over long runs instead of fragmenting towards an OOM. The graph 
+            ## path must keep the pool intact: replays write into the very 
+            ## blocks reserved at capture time
+
+        index += chunk_size
+
+    if input_compressed:
+        hdf5_file.close()
+
+    print("vABC algorithm completed!")
+
+def main():
+    """
+    Main function that executes the vABC algorithm.
+    """
+
+    """
+    Input data file should have the shape:
+    frame_length	Ti	        Cb	        0	        1	        2
+    0	            0.133333333	0.632698	0.040760215	0.036601037	0.028408282
+    0.166666667	    0.35	    140.5885	18.177458	17.420736	16.563547
+    0.166666667	    0.516666667	17912.979	0	        0	        0
+    0.166666667	    0.683333333	4444.976	8.17E-08	6.64E-08	4.08E-08
+    0.166666667	    0.85	    2675.443	0.001335959	0.000509933	0.000515968
+
+    The following columns are all TACs of the voxels.
+    frame_length is the time frame size.
+    Ti is the time after administration of the tracer.
+    Cb is the whole blood input function.
+        (Or equavalently Ca, the plasma input function)
+
+    If input data is an HDF5 file, the key should be "df".
+    """
+    global MEMORY_POOL
+    try:
+        MEMORY_POOL = cp.cuda.MemoryAsyncPool()
+        cp.cuda.set_allocator(MEMORY_POOL.malloc)
+        ## delegate allocations to the driver's stream-ordered pool, which
+        ## recycles blocks across streams and defragments on its own, so
+        ## long runs with heavy allocation churn stop creeping towards OOM
+    except RuntimeError:
+        MEMORY_POOL = cp.get_default_memory_pool()
+        ## needs CUDA 11.2+ with driver support; keep the default pool
+
+    path_data = "sample_data.csv"
+    path_output_para = "parameters.csv"
+    path_output_model = "model.csv"
+
+    seed = 2023
+    cp.random.seed(seed) ## for reproducibility
+
+    chunk_size = None ## None probes free GPU memory and picks the largest
+                      ## batch that fits; set an int to override
+
+    S = 1*10**5 ## number of prior simulations
+    thresh = 0.023357214690901212 ## threshold for acceptance
+    model_0_prob_thres = 0.5 ## threshold for model 0 probability
+    num_voxel = None ## number of voxels to process. If None, all voxels are
+    write_paras = True ## flag indicating whether to write parameter posterior
+    input_compressed = False ## flag indicating whether the input data is compressed (hdf5/csv)
+    output_compressed = False
+    ## flag indicating whether to compress the output 
+    ## posteriors (hdf5/csv).
+    finer_t_size = 500 ## finer time frame size for smaller convolution error
+                       ## bigger values require more vram
+    distance_type = "L1" ## distance function to use
+    ## 
+    validation_mode = False ## flag indicating whether to use validation mode
+    use_cuda_graph = False ## flag indicating whether to replay the per-chunk 
+                           ## device pipeline as a CUDA graph; needs fixed 
+                           ## chunk shapes and a CUDA 11.3+ toolkit
+
+    par_mat = None
+    if validation_mode:
+    ## If validation mode is on, try to load precomputed models to save 
+    ## computation time
+        try:
+            priors = cp.load("parameter_matrix.npz")
+            par_mat = priors["par_mat"]
+            model = priors["model"]
+            print("Priors loaded...")
+        except FileNotFoundError:
+            pass
+    if par_mat is None:
+        sampler = qmc.Sobol(d = 6, scramble = True, seed = seed)
+        quasi = cp.asarray(sampler.random(S))
+        ## scrambled Sobol points fill the prior hypercube far more evenly
+        ## than pseudorandom draws, so the same S covers parameter space
+        ## more densely (the sequence is best balanced when S is a power
+        ## of two)
+        Vb = 0.1 * quasi[:, 0]
+        alpha1 = 0.0005 + (0.02 - 0.0005) * quasi[:, 1]
+        alpha2 = 0.06 + (1 - 0.06) * quasi[:, 2]
+        theta1 = 0.5 * quasi[:, 3]
+        theta2 = 0.5 * quasi[:, 4]
+        Kb = 0.9 * quasi[:, 5] ## 0.263±0.134, take 3 sds
+        model = cp.random.binomial(1, 0.5, S).astype(cp.uint8)
+        ## one byte per draw; a binary flag has no business being int64
+        ## the binary model indicator stays an independent Bernoulli draw,
+        ## outside the low-discrepancy core
+        Kb[model == 0] = 0
+
+        par_mat = cp.column_stack((Vb, alpha1, alpha2, theta1, theta2, Kb))
+        ## only the kinetic parameters are stacked; the model flag stays a
+        ## separate 1-D array so the broadcast model tensor never carries it
+        ## stacked as input
+        cp.savez_compressed("parameter_matrix", par_mat = par_mat, 
+                            model = model)
+        print("Priors generated...")
+
+    vABC(num_voxel, path_data, path_output_para, path_output_model, par_mat, 
+         model, S, thresh, model_0_prob_thres, write_paras, input_compressed, 
+         output_compressed, chunk_size, finer_t_size, 
+         distance_type = distance_type, validation_mode = validation_mode, 
+         hyperparameter = None, use_cuda_graph = use_cuda_graph)
+    
+if __name__ == "__main__":
+    print("Starting vABC algorithm...")
     main()
\ No newline at end of file
@@ -1,663 +1,879 @@
-"""
-==================================
-// LICENSE:
-// Copyright 2024 University of Sydney
-// Use of this source code is governed by an MIT-style
-// license that can be found in the LICENSE file or at
-// https://opensource.org/licenses/MIT.
-// ===============================
-// AUTHOR       : Qinlin (Alistair) Gu, 
-//                modified based on Dr. Clara Grazian's original R code.
-// CREATE DATE  : 26/03/2024
-// PURPOSE      : To perform the vABC algorithm using GPU acceleration.
-// SPECIAL NOTES:
-// ===============================
-// Change History:
-// 20/06/2024 - Qinlin (Alistair) Gu - Copied from the 2TCM version and modified
-//                                     for the lpnt/MRTM version.
-==================================
-"""
-
-import cupy as cp
-import pandas as pd
-import numpy as np
-import os
-import warnings
-from tqdm import tqdm
-
-# Filter out FutureWarnings in Pandas
-warnings.filterwarnings("ignore", category=FutureWarning)
-
-def extract_values(df):
-    """
-    Extracts the values from the given DataFrame.
-
-    Args:
-        df (pd.DataFrame): Input DataFrame.
-
-    Returns:
-        tuple: A tuple containing the extracted values.
-            Each has a shape of (num_time_frame).
-    """
-    time_frame_size = cp.array(df.iloc[:, 0]).astype(cp.float32)
-    Ti = cp.array(df.iloc[:, 1].values).astype(cp.float32)
-    Cr = cp.array(df.iloc[:, 2].values).astype(cp.float32)
-
-    return time_frame_size, Cr, Ti
-
-def extract_TAC_chunks(df, index, chunk_size, num_voxel):
-    """
-    Extracts chunks of TAC (Time-Activity Curve) from the given DataFrame.
-    Chunks are used so that only a proportion of the data is loaded into memory 
-        at a time, preventing memory overflow.
-
-    Args:
-        df (pd.DataFrame): Input DataFrame.
-        index (int): Starting index of the chunk.
-        chunk_size (int): Size of each chunk.
-        num_voxel (int): Number of voxels.
-
-    Returns:
-        cp.ndarray: Extracted TAC chunks, shaped as (num_time_frame, num_voxel).
-    """
-    df_column_size = df.shape[1]
-    num_of_other_columns = 3 ## 3 columns are for time_frame_size, Cb, and Ti
-    if num_voxel is None: ## When None, use all voxels
-        num_voxel = df_column_size - num_of_other_columns
-    chunk_end = min(index + chunk_size, df_column_size, num_voxel + num_of_other_columns)
-    Ct = cp.array(df.iloc[:, index: chunk_end].values).astype(cp.float32)
-
-    return Ct
-
-def output_file_init(path_output_para, path_output_model, write_paras, output_compressed):
-    """
-    Initializes the output files for parameter and model data, so that results
-        can be recorded in chunks.
-
-    Args:
-        path_output_para (str): Path to the parameter output file.
-        path_output_model (str): Path to the model output file.
-        write_paras (bool): flag indicating whether to write parameter posterior.
-        output_compressed (bool): flag indicating whether to compress the output 
-                                  posteriors (hdf5/csv). Note that the model 
-                                  probability posterior is always stored as a csv
-                                  as it is relatively small.
-    """
-    para_columns = ["TAC_No", "R_1", "K_2", "K_2a", 
-                    "gamma", "t_D", "t_P", "alpha", "model"]
-    num_of_columns = len(para_columns)
-    model_p_columns = ["Voxel_No", "model", "probability_of_model"]
-
-    if write_paras:
-        para_df = pd.DataFrame(columns = para_columns)
-        para_df.iloc[:, 0] = para_df.iloc[:, 0].astype(np.int32)
-        para_df.iloc[:, 1:num_of_columns-1] = para_df.iloc[:, 1:num_of_columns-1].astype(np.float32)
-        para_df.iloc[:, -1] = para_df.iloc[:, -1].astype(np.str_)
-        if output_compressed:
-            para_df.to_hdf(path_output_para, 
-                           key = "column_names", 
-                           format='table', 
-                           index = False, 
-                           mode = "w", 
-                           complevel = 9)
-        else:
-            para_df.to_csv(path_output_para, 
-                           index = False, 
-                           mode = "w", 
-                           # compression = "xz"
-                           )
-
-    model_p_df = pd.DataFrame(columns = model_p_columns)
-    model_p_df.to_csv( ## csv first, compression later, otherwise slow
-        path_output_model.replace("h5", "csv"), 
-        index = False, 
-        mode = "w", 
-        # compression = "xz"
-        )
-
-def output_dataframe(para, model_p, write_paras):
-    """
-    Prepares the output DataFrames for parameter and model data.
-
-    Args:
-        para (cp.ndarray): Parameter data. Contains Vb, alpha1, alpha2, theta1,
-            theta2, and model values.
-        model_p (cp.ndarray): Model data.
-        write_paras (bool): flag indicating whether to write parameter posterior.
-
-    Returns:
-        tuple: A tuple containing the prepared DataFrames.
-            para_df is the parameter posterior DataFrame. (K_1 etc.)
-            model_p_df is the model probability posterior DataFrame.
-    """
-    if write_paras:
-        para_df = pd.DataFrame(para)
-        para_df[0] = para_df.iloc[:, 0].astype(int)
-
-        cols_to_replace_as_NA_indices = [4, 5, 6, 7]
-        para_df.loc[
-            para_df.iloc[:, -1] == 'MRTM', 
-            para_df.columns[cols_to_replace_as_NA_indices]
-            ] = pd.NA
-
-        para_df.iloc[:, -1] = para_df.iloc[:, -1].replace({0: 'MRTM', 
-                                                           1: 'lp-nt'})
-    else:
-        para_df = None
-
-    model_p_df = pd.DataFrame(model_p)
-    model_p_df[0] = model_p_df.iloc[:, 0].astype(int)
-    model_p_df[2] = model_p_df.iloc[:, 2].astype(float)
-    model_p_df.iloc[:, 2] = np.where(model_p_df.iloc[:, 1] == 1, 
-                                     1 - model_p_df.iloc[:, 2], 
-                                     model_p_df.iloc[:, 2])
-    model_p_df.iloc[:, 1] = model_p_df.iloc[:, 1].replace({0: 'MRTM', 
-                                                           1: 'lp-nt'})
-
-    return para_df, model_p_df
-
-def write_csv_chunks(para_df, 
-                     model_p_df, 
-                     path_output_para, 
-                     path_output_model, 
-                     write_paras, 
-                     output_compressed):
-    """
-    Writes the parameter and model data to CSV files in chunks.
-
-    Args:
-        para_df (pd.DataFrame): Parameter data.
-        model_p_df (pd.DataFrame): Model data.
-        path_output_para (str): Path to the parameter output file.
-        path_output_model (str): Path to the model output file.
-        write_paras (bool): flag indicating whether to write parameter posterior.
-        output_compressed (bool): flag indicating whether to compress the output 
-                                  posteriors (hdf5/csv). Note that the model 
-                                  probability posterior is always stored as a csv
-                                  as it is relatively small.
-    """
-    if write_paras:
-        para_columns = ["TAC_No", "R_1", "K_2", "K_2a", 
-                        "gamma", "t_D", "t_P", "alpha", "model"]
-        num_of_columns = len(para_columns)
-        para_df.columns = para_columns
-
-        unique_voxels = para_df.iloc[:, 0].unique()
-        min_index = np.min(unique_voxels)
-        max_index = np.max(unique_voxels)
-        para_df.iloc[:, 0] = para_df.iloc[:, 0].astype(np.int32)
-        para_df.iloc[:, 1:num_of_columns-1] = para_df.iloc[:, 1:num_of_columns-1].astype(np.float32)
-        para_df.iloc[:, -1] = para_df.iloc[:, -1].astype(np.str_)
-        if output_compressed:
-            para_df.to_hdf(path_output_para, 
-                        key = f"voxel_{min_index}_{max_index}", 
-                        format='table', 
-                        index = False, 
-                        mode = 'a', 
-                        complevel = 9, 
-                        min_itemsize = {'model': 11})
-        else:
-            para_df.to_csv(
-                path_output_para, 
-                header = False, 
-                index = False, 
-                mode = "a", 
-                # compression = "xz"
-                )
-
-    model_p_df.to_csv(
-        path_output_model.replace("h5", "csv"), 
-        header = False, 
-        index = False, 
-        mode = "a", 
-        # compression = "xz"
-        )
-    
-def compress_csv(path_output_model):
-    """
-    Compresses the model output CSV file to HDF5 format, when all are done
-
-    Args:
-        path_output_model (str): Path to the model output file.
-    """
-    path_output_model_csv = path_output_model.replace("h5", "csv")
-    df = pd.read_csv(path_output_model_csv)
-    df.iloc[:, 0] = df.iloc[:, 0].astype(np.int32)
-    df.iloc[:, 1] = df.iloc[:, 1].astype(np.str_)
-    df.iloc[:, 2] = df.iloc[:, 2].astype(np.float32)
-    df.to_hdf(path_output_model, 
-              key = "df", 
-              index = False, 
-              mode = "w", 
-              complevel = 9)
-
-    if os.path.exists(path_output_model_csv):
-        os.remove(path_output_model_csv)
-
-def get_Ct(time_frame_size, Cr, Cr_cumsum, Ct, Ct_cumsum_neg, Ti, paras):
-    """
-    Generates FDG (Fluorodeoxyglucose) model TACs using simulated priors.
-
-    Args:
-        time_frame_size (cp.ndarray): Time frame size.
-        Cr (cp.ndarray): Cr values.
-        Cr_cumsum (cp.ndarray): Cumulative sum of Cr values.
-        Ct (cp.ndarray): Ct values.
-        Ct_cumsum_neg (cp.ndarray): Negative cumulative sum of Ct values.
-        Ti (cp.ndarray): Ti values.
-        paras (cp.ndarray): Parameter values. Contains Vb, alpha1, alpha2,
-            theta1, theta2, and model values.
-
-    Returns:
-        cp.ndarray: model TACs.
-    """
-    R1, K2, K2a, gamma, tD, tP, alpha, model = [row for row in paras]
-
-    Ind = (Ti - tD) > 0
-    ht = cp.maximum(0, (Ti - tD) / (tP - tD)) ** alpha * \
-        cp.exp(alpha * (1 - (Ti - tD) / (tP - tD))) * Ind
-
-    ## model mask
-    model_mask = model.squeeze() == 0
-
-    # if model == 1:
-    theta = cp.stack([R1, K2, K2a, gamma], axis = 2)
-    # if model == 0:
-    model_mask = model_mask[None, :, None]
-    theta[:, :, -1, :][model_mask] = 0
-    mask_shape = cp.broadcast(cp.empty(Ct.shape, dtype = cp.float16), 
-                              cp.empty(ht.shape, dtype = cp.float16)).shape
-    model_mask = cp.broadcast_to(model_mask, mask_shape)
-    Ct_ht = cp.where(model_mask, 0, -cp.cumsum(Ct * ht, axis = -1))
-
-    target_shape = Ct_ht.shape
-
-    Cr_broadcasted = cp.broadcast_to(Cr, target_shape)
-    Cr_cumsum_broadcasted = cp.broadcast_to(Cr_cumsum, target_shape)
-    Ct_cumsum_neg_broadcasted = cp.broadcast_to(Ct_cumsum_neg, target_shape)
-    # Ct_ht already has the desired shape, so no need to broadcast
-
-    # Now stack them along the fourth dimension
-    BigMat = cp.stack((Cr_broadcasted, 
-                       Cr_cumsum_broadcasted * time_frame_size, 
-                       Ct_cumsum_neg_broadcasted * time_frame_size, 
-                       Ct_ht * time_frame_size), 
-                       axis = -1)
-
-    bigmat_shape = BigMat.shape
-    theta_shape = (bigmat_shape[0], bigmat_shape[1], bigmat_shape[3], 1)
-    theta = cp.broadcast_to(theta, theta_shape)
-
-    M = cp.einsum('ijkl,ijln->ijkn', BigMat, theta)
-
-    return M.squeeze(axis = -1)
-
-def generate_models(time_frame_size, Cr, Cr_cumsum, Ct, Ct_cumsum, Ti, par_mat):
-    """
-    A wrapper function to generate FDG models using the given parameters,
-    including fitting the input function for minimal convolution error.
-
-    Args:
-        time_frame_size (cp.ndarray): Time frame size.
-        Cr (cp.ndarray): Cr values.
-        Cr_cumsum (cp.ndarray): Cumulative sum of Cr values.
-        Ct (cp.ndarray): Ct values.
-        Ct_cumsum (cp.ndarray): Cumulative sum of Ct values.
-        Ti (cp.ndarray): Ti values.
-        par_mat (cp.ndarray): Parameter matrix.
-
-    Returns:
-        cp.ndarray: FDG model TACs using the prior simulations.
-    """
-
-    time_frame_size = time_frame_size[None, None, :]
-    Cr = Cr[None, None, :]
-    Cr_cumsum = Cr_cumsum[None, None, :]
-    Ct = Ct.T[:, None, :]
-    Ct_cumsum_neg = -Ct_cumsum.T[:, None, :]
-    Ti = Ti[None, None, :]
-    ## shape (1, 1, num_time_frame)
-    ## to match (num_vox, num_prior_simulation_size, num_time_frame)
-    paras = par_mat.T[:, None, :, None]
-    ## shape (num_variable, 1, num_prior_simulation_size, 1)
-    ## to match (num_variable, num_vox, num_prior_simulation_size, num_time_frame)
-
-    M = get_Ct(time_frame_size, Cr, Cr_cumsum, Ct, Ct_cumsum_neg, Ti, paras)
-
-    return M
-
-def distance_function(M, Ct, distance_type, validation_mode=False, 
-                      hyperparameter=None):
-    """
-    Calculates the distance function between the model and the observed data.
-    
-    Args:
-        M (cp.ndarray): FDG model TACs using the prior simulations.
-            (num_vox, num_prior_simulation_size, num_time_frame)
-        Ct (cp.ndarray): TAC chunks.
-            (num_vox, 1, num_time_frame)
-        distance_type (str): Type of distance function to use. Options are:
-            "L1", "L2", "Cauchy", "Huber", "Welsch", "CvM".
-            L1: L1 distance. L1 norm is the sum of the absolute values of the 
-                             vector.
-            L2: L2 distance. L2 norm is the square root of the sum of the 
-                             squared values of the vector.
-            Cauchy: Cauchy distance. Cauchy loss is the sum of the logarithm of 
-                                     1 plus the square of the vector divided by 
-                                     gamma.
-            Huber: Huber distance. Huber loss is the convolution of the absolute
-                                   value function with the rectangular function,
-                                   scaled and translated.
-            Welsch: Welsch distance. Welsch loss is the sum of 1 minus the 
-                                     exponential of the square of the vector 
-                                     divided by gamma.
-            CvM: Cramer-von Mises distance. CvM norm is the sum of the square of
-                                            the ranks of the vector.
-        validation_mode (bool): flag indicating whether to use validation mode.
-        hyperparameter (float): Hyperparameter value for the distance function.
-            Tunable.
-
-    Returns:
-        cp.ndarray: Errors calculated using the given distance function.
-    """
-    if distance_type == "L1":
-        errors = cp.sum(cp.abs(M - Ct), axis = -1)
-    elif distance_type == "L2":
-        errors = cp.sum(cp.square(M - Ct), axis = -1)
-    elif distance_type == "Cauchy":
-        gamma = hyperparameter if validation_mode else 19320.175439
-        errors = cp.sum(cp.log(1 + cp.square((M - Ct) / gamma)), axis = -1)
-    elif distance_type == "Huber":
-        delta = hyperparameter if validation_mode else 10925.438596
-        errors = cp.sum(cp.where(cp.abs(M - Ct) <= delta, 
-                                 0.5 * cp.square(M - Ct), 
-                                 delta * (cp.abs(M - Ct) - 0.5 * delta)), 
-                        axis = -1)
-    elif distance_type == "Welsch":
-        gamma = hyperparameter if validation_mode else 19701.754386
-        errors = cp.sum(1 - cp.exp(-cp.square((M - Ct) / gamma)), axis = -1)
-    elif distance_type == "CvM":
-        M_sorted = cp.sort(M, axis = -1)
-        Ct_sorted = cp.sort(Ct, axis = -1)
-        shape = (Ct_sorted.shape[0], M_sorted.shape[1], M_sorted.shape[2])
-        M_sorted = cp.broadcast_to(M_sorted, shape)
-        Ct_sorted = cp.broadcast_to(Ct_sorted, shape)
-        combined_sorted = cp.sort(
-            cp.concatenate((M_sorted, Ct_sorted), axis = -1), 
-            axis = -1
-            )
-        ranks_M = cp.sum(
-            combined_sorted[..., None, :] < M_sorted[..., None], 
-            axis = -1
-        )
-        ranks_Ct = cp.sum(
-            combined_sorted[..., None, :] < Ct_sorted[..., None],
-            axis = -1
-        )
-        M = M.shape[-1]
-        N = Ct.shape[-1]
-        i_list = cp.arange(M)
-        j_list = cp.arange(N)
-        U = M * cp.sum(cp.square(ranks_M - i_list), axis = -1) + \
-            N * cp.sum(cp.square(ranks_Ct - j_list), axis = -1)
-        errors = U / (M * N * (M + N)) - (4 * M * N - 1) / (6 * (M + N))
-        errors = errors + cp.random.normal(0, 0.0001, errors.shape)
-    else:
-        return distance_function(M, Ct, "L1")
-
-    return errors
-
-def calculate_results(M, par_mat, Ct, S, thresh, write_paras, 
-                      model_0_prob_thres=0.5, vox_num_start=0, 
-                      distance_type="L1", validation_mode=False, 
-                      hyperparameter=None):
-    """
-    Calculates the accepted simulations based on the given inputs.
-
-    Args:
-        M (cp.ndarray): FDG model TACs using the prior simulations.
-            (num_vox, num_prior_simulation_size, num_time_frame)
-        par_mat (cp.ndarray): Parameter matrix.
-            (num_prior_simulation_size, num_variable)
-        Ct (cp.ndarray): TAC chunks.
-            (num_time_frame, num_vox)
-        S (int): Prior simulation size. i.e. num_prior_simulation_size
-        thresh (float): Threshold value for acceptance. Tunable.
-        write_paras (bool): flag indicating whether to write parameter posterior.
-        model_0_prob_thres (float): Threshold for model 0 probability. Tunable.
-        vox_num_start (int): Starting voxel number. For batching purpose.
-        distance_type (str): Type of distance function to use. Options are:
-            "L1", "L2", "Cauchy", "Huber", "Welsch", "CvM".
-        validation_mode (bool): flag indicating whether to use validation mode.
-        hyperparameter (float): Hyperparameter value for the distance function.
-            Tunable.
-
-    Returns:
-        tuple: A tuple containing the accepted parameter posteriors and model 
-            probabilities.
-    """
-    num_vox = Ct.shape[-1]
-    num_variable = 8
-
-    voxel_numbers = cp.arange(num_vox) + vox_num_start
-
-    Ct = Ct.T[:, None, :] ## (num_vox, 1, num_time_frame), 
-                          ## second dimension for broadcasting
-    errors = distance_function(
-        M, 
-        Ct, 
-        distance_type = distance_type, 
-        validation_mode = validation_mode, 
-        hyperparameter = hyperparameter
-        )
-    ## calculate errors along time_frame axis
-    ## (num_vox, num_prior_simulation_size)
-    h = cp.quantile(errors, thresh, axis = -1) ## along num_prior_simulation_size axis
-                                               ## (num_vox)
-    accepted_mask = errors <= h[:, None] ## (num_vox, num_prior_simulation_size)
-    accepted_size = int(cp.count_nonzero(accepted_mask[0]))
-    ## This usually is fine but is risky
-    ## Sometimes for special distance functions, there can be ties
-    ## Leading to different accepted_size
-    ## Making the vectorisation of the code not work
-
-    ## was (num_prior_simulation_size, num_variable)
-    par_mat_broadcast_shape = (num_vox, S, num_variable)
-    par_mat = cp.broadcast_to(par_mat, par_mat_broadcast_shape)
-    ## to repeat the par_mat for each voxel, for output purpose
-    ## (num_vox, num_prior_simulation_size, num_variable)
-    accepted_mask = cp.broadcast_to(accepted_mask[:, :, None], 
-                                    par_mat_broadcast_shape)
-    ## mask was (num_vox, num_prior_simulation_size)
-    ## mask repeated for each variable
-    ## (num_vox, num_prior_simulation_size, num_variable)
-    accepted = par_mat[accepted_mask]
-    accepted = accepted.reshape(num_vox, accepted_size, num_variable)
-    ## reshaping needed because applying the mask will flatten the array
-    ## (num_vox, accepted_size, num_variable)
-    ## Errors will happen if accepted_size is different for different voxels
-    ## Potential risky distance functions include those using ranks
-
-    models = accepted[:, :, -1] ## (num_vox, accepted_size)
-                                ## array of models accepted for each voxel
-    percentage_zeros = cp.mean(models == 0, axis = -1) ## along accepted_size axis
-    models = (percentage_zeros < model_0_prob_thres).astype(cp.int32)
-    model_p = cp.column_stack((voxel_numbers, models, percentage_zeros))
-    model_p = model_p.get()
-
-    if write_paras:
-        accepted = accepted.reshape(num_vox * accepted_size, num_variable)
-        voxel_numbers = voxel_numbers.repeat(accepted_size)
-        accepted = cp.column_stack((voxel_numbers, accepted))
-        accepted = accepted.get()
-    else:
-        accepted = None
-
-    return accepted, model_p
-
-def vABC(num_voxel, path_data, path_output_para, path_output_model, par_mat, S, 
-         thresh, model_0_prob_thres, write_paras, input_compressed=False, 
-         output_compressed=False, chunk_size=25, finer_t_size=1000, 
-         distance_type="L1", validation_mode=False, hyperparameter=None):
-    """
-    Performs the vABC (Variational Approximate Bayesian Computation) algorithm.
-
-    Args:
-        num_voxel (int): Number of voxels to process. If None, all voxels are
-        path_data (str): Path to the input data file.
-        path_output_para (str): Path to the parameter posterior output file.
-        path_output_model (str): Path to the model probability posterior output file.
-        par_mat (cp.ndarray): Parameter matrix, size (num_prior_simulation_size, num_variable).
-        S (int): Size of the simulation. i.e. num_prior_simulation_size
-        thresh (float): Threshold value for acceptance. Tunable.
-        model_0_prob_thres (float): Threshold for model 0 probability. Tunable.
-        write_paras (bool): flag indicating whether to write parameter posterior.
-        input_compressed (bool): flag indicating whether the input data is compressed (hdf5/csv).
-        output_compressed (bool): flag indicating whether to compress the output 
-                                  posteriors (hdf5/csv). Note that the model 
-                                  probability posterior is always stored as a csv
-                                  as it is relatively small.
-        chunk_size (int): Size of each chunk. Used to prevent memory overflow.
-        distance_type (str): Type of distance function to use. Options are:
-            "L1", "L2", "Cauchy", "Huber", "Welsch", "CvM".
-        validation_mode (bool): flag indicating whether to use validation mode.
-        hyperparameter (float): Hyperparameter value for the distance function.
-            Tunable.
-    """
-    if input_compressed:
-        df = pd.read_hdf(path_data, "df") ## alter, use read_csv(chunksize=)
-    else:
-        df = pd.read_csv(path_data)
-    time_frame_size, Cr, Ti = extract_values(df)
-    Cr_cumsum = cp.cumsum(Cr, axis = 0)
-    print("Data extracted...")
-
-    index = 3 ## ignoring the first 3 columns
-              ## which are for time_frame_size, Cb, and Ti
-    df_column_size = df.shape[1] ## number of columns in the DataFrame
-
-    output_file_init(
-        path_output_para, 
-        path_output_model, 
-        write_paras, 
-        output_compressed
-        )
-    ## initialise the output files
-    print("Output files initialised...")
-
-    if num_voxel is None: ## When None, use all voxels
-        num_voxel = df_column_size - 3
-
-    # Calculate the number of iterations needed for the tqdm progress bar
-    total_iterations = min(num_voxel, df_column_size - 3) / chunk_size
-    total_iterations = int(total_iterations) if total_iterations.is_integer() else int(total_iterations) + 1
-
-    for _ in tqdm(range(total_iterations)):
-        ## batching to prevent memory overflow
-        if index >= df_column_size or index >= num_voxel + 3:
-            break
-
-        Ct = extract_TAC_chunks(df, index, chunk_size, num_voxel)
-        Ct_cumsum = cp.cumsum(Ct, axis = 0)
-        M = generate_models(
-            time_frame_size, Cr, Cr_cumsum, Ct, Ct_cumsum, Ti, par_mat
-        )
-        para, model_p = calculate_results(M, par_mat, Ct, S, thresh, write_paras, 
-                                          model_0_prob_thres, index - 3, 
-                                          distance_type = distance_type, 
-                                          validation_mode = validation_mode, 
-                                          hyperparameter = hyperparameter)
-        para_df, model_p_df = output_dataframe(para, model_p, write_paras)
-        write_csv_chunks(para_df, model_p_df, path_output_para, path_output_model, 
-                         write_paras, output_compressed)
-        
-        index += chunk_size
-
-    if output_compressed:
-        print("Compressing the model output...")
-        compress_csv(path_output_model)
-        print("Model output compressed...")
-
-    print("vABC algorithm completed!")
-
-def main():
-    """
-    Main function that executes the vABC algorithm.
-    """
-
-    """
-    Input data file should have the shape:
-    frame_length	Ti	        Cb	        0	        1	        2
-    0	            0.133333333	0.632698	0.040760215	0.036601037	0.028408282
-    0.166666667	    0.35	    140.5885	18.177458	17.420736	16.563547
-    0.166666667	    0.516666667	17912.979	0	        0	        0
-    0.166666667	    0.683333333	4444.976	8.17E-08	6.64E-08	4.08E-08
-    0.166666667	    0.85	    2675.443	0.001335959	0.000509933	0.000515968
-
-    The following columns are all TACs of the voxels.
-    frame_length is the time frame size.
-    Ti is the time after administration of the tracer.
-    Cb is the whole blood input function.
-        (Or equavalently Ca, the plasma input function)
-
-    If input data is an HDF5 file, the key should be "df".
-    """
-    path_data = "../Code from Clara/data/vABC_data_null.csv"
-    path_output_para = "parameters.csv"
-    path_output_model = "model.csv"
-
-    seed = 2023
-    cp.random.seed(seed) ## for reproducibility
-
-    chunk_size = 2 ## Adjust as needed, to prevent memory overflow
-
-    S = 2*10**6 ## number of prior simulations
-    thresh = 0.00029974212515947 ## threshold for acceptance
-    model_0_prob_thres = 0.5 ## threshold for model 0 probability
-    num_voxel = 100 ## number of voxels to process. If None, all voxels are
-    write_paras = True ## flag indicating whether to write parameter posterior
-    input_compressed = False ## flag indicating whether the input data is compressed (hdf5/csv)
-    output_compressed = False
-    ## flag indicating whether to compress the output 
-    ## posteriors (hdf5/csv). Note that the model 
-    ## probability posterior is always stored as a csv initially
-    ## as it is relatively small, but can be compressed if needed.
-
-    distance_type = "L1" ## distance function to use
-    ## 
-    validation_mode = False ## flag indicating whether to use validation mode
-
-    par_mat = None
-    if validation_mode:
-    ## If validation mode is on, try to load precomputed models to save 
-    ## computation time
-        try:
-            par_mat = cp.load("parameter_matrix.npz")["par_mat"]
-            print("Priors loaded...")
-        except FileNotFoundError:
-            pass
-    if par_mat is None:
-        model = cp.random.binomial(1, 0.5, S)
-        R1 = cp.random.uniform(0.2, 1.7, S)
-        K2 = cp.random.uniform(0.1, 0.45, S)
-        K2a = cp.random.uniform(0, 0.1, S)
-        gamma = cp.random.uniform(0, 0.4, S)
-        tD = cp.random.uniform(30, 50, S)
-        tP = cp.random.uniform(tD + 1, 60, S)
-        alpha = cp.random.uniform(0, 4, S)
-        gamma[model == 0] = 0 ## model 0 for MRTM, model 1 for lp-nt
-
-        par_mat = cp.column_stack((R1, K2, K2a, gamma, tD, tP, alpha, model))
-        ## stacked as input
-        cp.savez_compressed("parameter_matrix", par_mat = par_mat)
-        print("Priors generated...")
-
-    vABC(num_voxel, path_data, path_output_para, path_output_model, par_mat, 
-         S, thresh, model_0_prob_thres, write_paras, input_compressed, 
-         output_compressed, chunk_size, 
-         distance_type = distance_type, validation_mode = validation_mode, 
-         hyperparameter = None)
-    
-if __name__ == "__main__":
-    print("Starting vABC algorithm...")
+"""
+==================================
+// LICENSE:
+// Copyright 2024 University of Sydney
+// Use of this source code is governed by an MIT-style
+// license that can be found in the LICENSE file or at
+// https://opensource.org/licenses/MIT.
+// ===============================
+// AUTHOR       : Qinlin (Alistair) Gu, 
+//                modified based on Dr. Clara Grazian's original R code.
+// CREATE DATE  : 26/03/2024
+// PURPOSE      : To perform the vABC algorithm using GPU acceleration.
+// SPECIAL NOTES:
+// ===============================
+// Change History:
+// 27/08/2026 - Qinlin (Alistair) Gu - Compressed outputs now stream straight
+//                                     into extendable HDF5 datasets; the
+//                                     csv-then-compress step is removed.
+// 27/08/2026 - Qinlin (Alistair) Gu - chunk_size = None (new default) probes
+//                                     free GPU memory and sizes batches
+//                                     adaptively per distance type.
+// 27/08/2026 - Qinlin (Alistair) Gu - Priors are drawn from scrambled Sobol
+//                                     sequences; scipy is now a dependency.
+// 27/08/2026 - Qinlin (Alistair) Gu - Fused GPU distance kernel, fixed-count
+//                                     partition acceptance, and pinned
+//                                     asynchronous transfers.
+// 20/06/2024 - Qinlin (Alistair) Gu - Copied from the 2TCM version and modified
+//                                     for the lpnt/MRTM version.
+==================================
+"""
+
+import cupy as cp
+import pandas as pd
+import numpy as np
+from scipy.stats import qmc
+import h5py
+import os
+import warnings
+from tqdm import tqdm
+
+# Filter out FutureWarnings in Pandas
+warnings.filterwarnings("ignore", category=FutureWarning)
+
+MODEL_NAMES = ("MRTM", "lp-nt")
+MEMORY_POOL = cp.get_default_memory_pool()
+## the pool the installed allocator actually serves from; main rebinds
+## this when it switches to the stream-ordered pool, so pool trims always
+## reach the active allocator instead of a bypassed one
+PARA_ROW_DTYPE = np.dtype([("TAC_No", "i4"), ("R_1", "f4"), 
+                           ("K_2", "f4"), ("K_2a", "f4"), ("gamma", "f4"), 
+                           ("t_D", "f4"), ("t_P", "f4"), ("alpha", "f4"), 
+                           ("model", "U5")])
+PARA_ROW_FMT = "%d,%.9g,%.9g,%.9g,%.9g,%.9g,%.9g,%.9g,%s"
+## one typed record per accepted simulation for the csv path; the format
+## string mirrors the fields, so the writer never goes through pandas
+## names of model codes 0 and 1, used wherever the numeric model column is
+## rendered for output
+
+## Fused |M - Ct| reduction over the time-frame axis. A single reduction
+## kernel streams over the prior simulations without ever materialising the
+## (num_vox, num_prior_simulation_size, num_time_frame) difference tensor
+## that cp.abs(M - Ct) would allocate. Defined at module scope so the JIT
+## compilation happens only once. The inputs are upcast on load and the
+## accumulator is fixed at float32, so the summation stays accurate even if
+## the model tensor is ever stored in half precision.
+l1_distance = cp.ReductionKernel(
+    'T m, T c',                       ## in_params
+    'float32 err',                    ## out_params
+    'fabsf((float)m - (float)c)',     ## map, upcast before subtracting
+    'a + b',                          ## reduce, accumulated in float32
+    'err = a',                        ## post-reduction map
+    '0',                              ## identity
+    'l1_distance'                     ## kernel name
+)
+
+def extract_values(df):
+    """
+    Extracts the values from the given DataFrame.
+
+    Args:
+        df (pd.DataFrame): Input DataFrame.
+
+    Returns:
+        tuple: A tuple containing the extracted values.
+            Each has a shape of (num_time_frame).
+    """
+    time_frame_size = cp.array(df.iloc[:, 0]).astype(cp.float32)
+    Ti = cp.array(df.iloc[:, 1].values).astype(cp.float32)
+    Cr = cp.array(df.iloc[:, 2].values).astype(cp.float32)
+
+    return time_frame_size, Cr, Ti
+
+def rechunk_input_hdf5(path_data, chunk_size):
+    """
+    Rewrites a pandas-written input HDF5 into a column-chunked layout that
+        matches the voxel-chunk access pattern. pd.to_hdf stores the table
+        row-oriented, so slicing a column slab forces the HDF5 library to
+        read and decompress the whole file for every chunk. A one-time
+        rewrite into a dataset chunked as (num_time_frame, chunk_size)
+        makes each voxel chunk a single contiguous read.
+
+    Args:
+        path_data (str): Path to the pandas-written input HDF5.
+        chunk_size (int): Number of voxels read per chunk. None falls 
+            back to a generic column chunk of 256.
+
+    Returns:
+        str: Path of the rechunked file.
+    """
+    root, ext = os.path.splitext(path_data)
+    path_rechunked = root + "_rechunked" + (ext or ".h5")
+    if os.path.exists(path_rechunked):
+        return path_rechunked ## already converted by an earlier run
+
+    values = pd.read_hdf(path_data, "df").values.astype(np.float32)
+    with h5py.File(path_rechunked, "w") as f:
+        f.create_dataset("TACs", 
+                         data = values, 
+                         chunks = (values.shape[0], 
+                                   min(chunk_size or 256, values.shape[1])), 
+                         compression = "gzip", 
+                         compression_opts = 3)
+
+    return path_rechunked
+
+def pin_host_array(array):
+    """
+    Copies a host array into page-locked (pinned) memory, so that H2D
+    transfers can run asynchronously on a CUDA stream.
+
+    Args:
+        array (np.ndarray): Host array to stage.
+
+    Returns:
+        np.ndarray: A pinned copy of the input array.
+    """
+    pinned = np.frombuffer(
+        cp.cuda.alloc_pinned_memory(array.nbytes), 
+        array.dtype, 
+        array.size
+        ).reshape(array.shape)
+    pinned[...] = array
+
+    return pinned
+
+def extract_TAC_chunks(source, index, chunk_size, num_voxel, stream=None):
+    """
+    Extracts chunks of TAC (Time-Activity Curve) from the given source.
+    Chunks are used so that only a proportion of the data is loaded into memory 
+        at a time, preventing memory overflow.
+
+    Args:
+        source (pd.DataFrame, h5py.Dataset or str): Input DataFrame, a 
+            column-chunked HDF5 dataset (see rechunk_input_hdf5), or the 
+            path of the input csv. For a dataset or a path, only the 
+            chunk's columns are read, so the full voxel matrix never has 
+            to sit in host RAM.
+        index (int): Starting index of the chunk.
+        chunk_size (int): Size of each chunk.
+        num_voxel (int): Number of voxels.
+        stream (cp.cuda.Stream): Optional stream for the upload. When given, 
+            the copy is issued asynchronously on it and the chunk is staged 
+            through pinned memory, so it can overlap GPU compute.
+
+    Returns:
+        cp.ndarray: Extracted TAC chunks, shaped as (num_time_frame, num_voxel).
+            When a stream is given, a (chunk, pinned_buffer) tuple is returned
+            instead; the pinned buffer must be kept alive until the stream is
+            synchronised.
+    """
+    if isinstance(source, str):
+        df_column_size = pd.read_csv(source, nrows = 0).shape[1]
+        ## only the header line is parsed to get the column count
+    else:
+        df_column_size = source.shape[1]
+    num_of_other_columns = 3 ## 3 columns are for time_frame_size, Cb, and Ti
+    if num_voxel is None: ## When None, use all voxels
+        num_voxel = df_column_size - num_of_other_columns
+    chunk_end = min(index + chunk_size, df_column_size, num_voxel + num_of_other_columns)
+    if isinstance(source, str):
+        values = pd.read_csv(source, 
+                             usecols = range(index, chunk_end), 
+                             dtype = np.float32).values
+    elif isinstance(source, pd.DataFrame):
+        values = source.iloc[:, index: chunk_end].values.astype(np.float32)
+    else: ## column-chunked h5py dataset, one contiguous read per chunk
+        values = source[:, index: chunk_end].astype(np.float32)
+    if stream is None:
+        return cp.array(values)
+
+    pinned = pin_host_array(values)
+    Ct = cp.empty(pinned.shape, dtype = cp.float32)
+    Ct.set(pinned, stream = stream)
+
+    return Ct, pinned
+
+def output_file_init(path_output_para, path_output_model, write_paras, output_compressed):
+    """
+    Initializes the output files for parameter and model data, so that results
+        can be recorded in chunks.
+
+    Args:
+        path_output_para (str): Path to the parameter output file.
+        path_output_model (str): Path to the model output file.
+        write_paras (bool): flag indicating whether to write parameter posterior.
+        output_compressed (bool): flag indicating whether to compress the output 
+                                  posteriors (hdf5/csv).
+    """
+    para_columns = ["TAC_No", "R_1", "K_2", "K_2a", 
+                    "gamma", "t_D", "t_P", "alpha", "model"]
+    num_of_columns = len(para_columns)
+    model_p_columns = ["Voxel_No", "model", "probability_of_model"]
+
+    if write_paras:
+        if output_compressed:
+            with h5py.File(path_output_para, "w") as f:
+                ds = f.create_dataset("parameters", 
+                                      shape = (0, num_of_columns), 
+                                      maxshape = (None, num_of_columns), 
+                                      chunks = True, 
+                                      compression = "lzf", 
+                                      dtype = "f4")
+                ## a single extendable dataset instead of one pytables key
+                ## per chunk; appends are cheap chunked writes with no
+                ## float-to-text conversion
+                ds.attrs["columns"] = para_columns
+                ds.attrs["model_names"] = MODEL_NAMES
+                ## the model column holds the numeric code; the mapping to
+                ## names is recorded alongside
+        else:
+            with open(path_output_para, "w") as f:
+                f.write(",".join(para_columns) + "\n")
+            ## just the header line; the typed rows follow in
+            ## write_csv_chunks
+
+    if output_compressed:
+        with h5py.File(path_output_model, "w") as f:
+            ds = f.create_dataset("model_probabilities", 
+                                  shape = (0, len(model_p_columns)), 
+                                  maxshape = (None, len(model_p_columns)), 
+                                  chunks = True, 
+                                  compression = "gzip", 
+                                  compression_opts = 3, 
+                                  dtype = "f4")
+            ## the model posterior streams straight into one extendable
+            ## dataset; no more temporary csv that had to be re-read and
+            ## rewritten as hdf5 at the end of the run
+            ds.attrs["columns"] = model_p_columns
+            ds.attrs["model_names"] = MODEL_NAMES
+    else:
+        model_p_df = pd.DataFrame(columns = model_p_columns)
+        model_p_df.to_csv(
+            path_output_model.replace("h5", "csv"), 
+            index = False, 
+            mode = "w", 
+            # compression = "xz"
+            )
+
+def output_dataframe(model_p):
+    """
+    Prepares the model probability posterior DataFrame. The parameter
+        posterior needs no preparation here any more: calculate_results
+        already assembles the final table on the GPU.
+
+    Args:
+        model_p (np.ndarray): Model data.
+
+    Returns:
+        pd.DataFrame: The model probability posterior DataFrame.
+    """
+    model_p_df = pd.DataFrame(model_p)
+    model_p_df[0] = model_p_df.iloc[:, 0].astype(int)
+    model_p_df[2] = model_p_df.iloc[:, 2].astype(float)
+    model_p_df.iloc[:, 2] = np.where(model_p_df.iloc[:, 1] == 1, 
+                                     1 - model_p_df.iloc[:, 2], 
+                                     model_p_df.iloc[:, 2])
+    ## the model column keeps its numeric code here; it becomes a name
+    ## only at the text boundary in write_csv_chunks
+
+    return model_p_df
+
+def write_csv_chunks(para, 
+                     model_p_df, 
+                     path_output_para, 
+                     path_output_model, 
+                     write_paras, 
+                     output_compressed):
+    """
+    Writes the parameter and model data to the output files in chunks.
+
+    Args:
+        para (np.ndarray): Parameter data, with the model column as its 
+            numeric code.
+        model_p_df (pd.DataFrame): Model data.
+        path_output_para (str): Path to the parameter output file.
+        path_output_model (str): Path to the model output file.
+        write_paras (bool): flag indicating whether to write parameter posterior.
+        output_compressed (bool): flag indicating whether to compress the output 
+                                  posteriors (hdf5/csv).
+    """
+    if write_paras:
+        if output_compressed:
+            rows = para.astype(np.float32)
+            with h5py.File(path_output_para, "a") as f:
+                ds = f["parameters"]
+                ds.resize(ds.shape[0] + rows.shape[0], axis = 0)
+                ds[-rows.shape[0]:] = rows
+        else:
+            rec = np.empty(para.shape[0], dtype = PARA_ROW_DTYPE)
+            rec[PARA_ROW_DTYPE.names[0]] = para[:, 0]
+            for i, name in enumerate(PARA_ROW_DTYPE.names[1:-1], start = 1):
+                rec[name] = para[:, i]
+            rec["model"] = np.asarray(MODEL_NAMES)[para[:, -1].astype(np.int64)]
+            ## one typed record block per chunk instead of three pandas
+            ## dtype cascades, each of which copied the whole block manager
+            with open(path_output_para, "a") as f:
+                np.savetxt(f, rec, fmt = PARA_ROW_FMT)
+
+    if output_compressed:
+        rows = model_p_df.to_numpy(dtype = np.float32)
+        with h5py.File(path_output_model, "a") as f:
+            ds = f["model_probabilities"]
+            ds.resize(ds.shape[0] + rows.shape[0], axis = 0)
+            ds[-rows.shape[0]:] = rows
+    else:
+        model_p_df.iloc[:, 1] = model_p_df.iloc[:, 1].astype(np.int64).map(
+            dict(enumerate(MODEL_NAMES))
+            ) ## the model code becomes its name only at the text boundary
+        model_p_df.to_csv(
+            path_output_model.replace("h5", "csv"), 
+            header = False, 
+            index = False, 
+            mode = "a", 
+            # compression = "xz"
+            )
+    
+def get_Ct(time_frame_size, Cr, Cr_cumsum, Ct, Ct_cumsum_neg, Ti, paras, 
+           model):
+    """
+    Generates FDG (Fluorodeoxyglucose) model TACs using simulated priors.
+
+    Args:
+        time_frame_size (cp.ndarray): Time frame size.
+        Cr (cp.ndarray): Cr values.
+        Cr_cumsum (cp.ndarray): Cumulative sum of Cr values.
+        Ct (cp.ndarray): Ct values.
+        Ct_cumsum_neg (cp.ndarray): Negative cumulative sum of Ct values.
+        Ti (cp.ndarray): Ti values.
+        paras (cp.ndarray): Kinetic parameter values. Contains R1, K2, K2a,
+            gamma, tD, tP, and alpha values.
+        model (cp.ndarray): Model flag prior draws, shape 
+            (num_prior_simulation_size,). Passed separately so the kinetic 
+            broadcast tensor does not carry it.
+
+    Returns:
+        cp.ndarray: model TACs.
+    """
+    R1, K2, K2a, gamma, tD, tP, alpha = [row for row in paras]
+
+    Ind = (Ti - tD) > 0
+    ht = cp.maximum(0, (Ti - tD) / (tP - tD)) ** alpha * \
+        cp.exp(alpha * (1 - (Ti - tD) / (tP - tD))) * Ind
+
+    ## model mask
+    model_mask = model == 0
+
+    # if model == 1:
+    theta = cp.stack([R1, K2, K2a, gamma], axis = 2)
+    # if model == 0:
+    model_mask = model_mask[None, :, None]
+    theta[:, :, -1, :][model_mask] = 0
+    mask_shape = cp.broadcast(cp.empty(Ct.shape, dtype = cp.float16), 
+                              cp.empty(ht.shape, dtype = cp.float16)).shape
+    model_mask = cp.broadcast_to(model_mask, mask_shape)
+    Ct_ht = cp.where(model_mask, 0, -cp.cumsum(Ct * ht, axis = -1))
+
+    target_shape = Ct_ht.shape
+
+    Cr_broadcasted = cp.broadcast_to(Cr, target_shape)
+    Cr_cumsum_broadcasted = cp.broadcast_to(Cr_cumsum, target_shape)
+    Ct_cumsum_neg_broadcasted = cp.broadcast_to(Ct_cumsum_neg, target_shape)
+    # Ct_ht already has the desired shape, so no need to broadcast
+
+    # Now stack them along the fourth dimension
+    BigMat = cp.stack((Cr_broadcasted, 
+                       Cr_cumsum_broadcasted * time_frame_size, 
+                       Ct_cumsum_neg_broadcasted * time_frame_size, 
+                       Ct_ht * time_frame_size), 
+                       axis = -1)
+
+    bigmat_shape = BigMat.shape
+    theta_shape = (bigmat_shape[0], bigmat_shape[1], bigmat_shape[3], 1)
+    theta = cp.broadcast_to(theta, theta_shape)
+
+    M = cp.einsum('ijkl,ijln->ijkn', BigMat, theta)
+
+    return M.squeeze(axis = -1)
+
+def generate_models(time_frame_size, Cr, Cr_cumsum, Ct, Ct_cumsum, Ti, par_mat, 
+                    model):
+    """
+    A wrapper function to generate FDG models using the given parameters,
+    including fitting the input function for minimal convolution error.
+
+    Args:
+        time_frame_size (cp.ndarray): Time frame size.
+        Cr (cp.ndarray): Cr values.
+        Cr_cumsum (cp.ndarray): Cumulative sum of Cr values.
+        Ct (cp.ndarray): Ct values.
+        Ct_cumsum (cp.ndarray): Cumulative sum of Ct values.
+        Ti (cp.ndarray): Ti values.
+        par_mat (cp.ndarray): Kinetic parameter matrix.
+        model (cp.ndarray): Model flag prior draws.
+
+    Returns:
+        cp.ndarray: FDG model TACs using the prior simulations.
+    """
+
+    time_frame_size = time_frame_size[None, None, :]
+    Cr = Cr[None, None, :]
+    Cr_cumsum = Cr_cumsum[None, None, :]
+    Ct = Ct.T[:, None, :]
+    Ct_cumsum_neg = -Ct_cumsum.T[:, None, :]
+    Ti = Ti[None, None, :]
+    ## shape (1, 1, num_time_frame)
+    ## to match (num_vox, num_prior_simulation_size, num_time_frame)
+    paras = par_mat.T[:, None, :, None]
+    ## shape (num_variable, 1, num_prior_simulation_size, 1)
+    ## to match (num_variable, num_vox, num_prior_simulation_size, num_time_frame)
+
+    M = get_Ct(time_frame_size, Cr, Cr_cumsum, Ct, Ct_cumsum_neg, Ti, paras, 
+               model)
+
+    ## the fused distance kernel binds M and Ct to a single type
+    ## placeholder, and CuPy does not implicitly cast user-kernel
+    ## arguments, so the float64 einsum output must come down to the
+    ## float32 the observed TACs are stored in
+    return M.astype(cp.float32)
+
+def distance_function(M, Ct, distance_type, validation_mode=False, 
+                      hyperparameter=None):
+    """
+    Calculates the distance function between the model and the observed data.
+    
+    Args:
+        M (cp.ndarray): FDG model TACs using the prior simulations.
+            (num_vox, num_prior_simulation_size, num_time_frame)
+        Ct (cp.ndarray): TAC chunks.
+            (num_vox, 1, num_time_frame)
+        distance_type (str): Type of distance function to use. Options are:
+            "L1", "L2", "Cauchy", "Huber", "Welsch", "CvM".
+            L1: L1 distance. L1 norm is the sum of the absolute values of the 
+                             vector.
+            L2: L2 distance. L2 norm is the square root of the sum of the 
+                             squared values of the vector.
+            Cauchy: Cauchy distance. Cauchy loss is the sum of the logarithm of 
+                                     1 plus the square of the vector divided by 
+                                     gamma.
+            Huber: Huber distance. Huber loss is the convolution of the absolute
+                                   value function with the rectangular function,
+                                   scaled and translated.
+            Welsch: Welsch distance. Welsch loss is the sum of 1 minus the 
+                                     exponential of the square of the vector 
+                                     divided by gamma.
+            CvM: Cramer-von Mises distance. CvM norm is the sum of the square of
+                                            the ranks of the vector.
+        validation_mode (bool): flag indicating whether to use validation mode.
+        hyperparameter (float): Hyperparameter value for the distance function.
+            Tunable.
+
+    Returns:
+        cp.ndarray: Errors calculated using the given distance function.
+    """
+    if distance_type == "L1":
+        errors = l1_distance(M, Ct, axis = -1)
+    elif distance_type == "L2":
+        errors = cp.sum(cp.square(M - Ct), axis = -1)
+    elif distance_type == "Cauchy":
+        gamma = hyperparameter if validation_mode else 19320.175439
+        errors = cp.sum(cp.log(1 + cp.square((M - Ct) / gamma)), axis = -1)
+    elif distance_type == "Huber":
+        delta = hyperparameter if validation_mode else 10925.438596
+        errors = cp.sum(cp.where(cp.abs(M - Ct) <= delta, 
+                                 0.5 * cp.square(M - Ct), 
+                                 delta * (cp.abs(M - Ct) - 0.5 * delta)), 
+                        axis = -1)
+    elif distance_type == "Welsch":
+        gamma = hyperparameter if validation_mode else 19701.754386
+        errors = cp.sum(1 - cp.exp(-cp.square((M - Ct) / gamma)), axis = -1)
+    elif distance_type == "CvM":
+        M_sorted = cp.sort(M, axis = -1)
+        Ct_sorted = cp.sort(Ct, axis = -1)
+        shape = (Ct_sorted.shape[0], M_sorted.shape[1], M_sorted.shape[2])
+        M_sorted = cp.broadcast_to(M_sorted, shape)
+        Ct_sorted = cp.broadcast_to(Ct_sorted, shape)
+        combined_sorted = cp.sort(
+            cp.concatenate((M_sorted, Ct_sorted), axis = -1), 
+            axis = -1
+            )
+        ranks_M = cp.sum(
+            combined_sorted[..., None, :] < M_sorted[..., None], 
+            axis = -1
+        )
+        ranks_Ct = cp.sum(
+            combined_sorted[..., None, :] < Ct_sorted[..., None],
+            axis = -1
+        )
+        M = M.shape[-1]
+        N = Ct.shape[-1]
+        i_list = cp.arange(M)
+        j_list = cp.arange(N)
+        U = M * cp.sum(cp.square(ranks_M - i_list), axis = -1) + \
+            N * cp.sum(cp.square(ranks_Ct - j_list), axis = -1)
+        errors = U / (M * N * (M + N)) - (4 * M * N - 1) / (6 * (M + N))
+        errors = errors + cp.random.normal(0, 0.0001, errors.shape)
+    else:
+        return distance_function(M, Ct, "L1")
+
+    return errors
+
+def calculate_results(M, par_mat, model, Ct, S, thresh, write_paras, 
+                      model_0_prob_thres=0.5, vox_num_start=0, 
+                      distance_type="L1", validation_mode=False, 
+                      hyperparameter=None, host_buffers=None):
+    """
+    Calculates the accepted simulations based on the given inputs.
+
+    Args:
+        M (cp.ndarray): FDG model TACs using the prior simulations.
+            (num_vox, num_prior_simulation_size, num_time_frame)
+        par_mat (cp.ndarray): Kinetic parameter matrix.
+            (num_prior_simulation_size, num_variable)
+        model (cp.ndarray): Model flag prior draws.
+            (num_prior_simulation_size,)
+        Ct (cp.ndarray): TAC chunks.
+            (num_time_frame, num_vox)
+        S (int): Prior simulation size. i.e. num_prior_simulation_size
+        thresh (float): Threshold value for acceptance. Tunable.
+        write_paras (bool): flag indicating whether to write parameter posterior.
+        model_0_prob_thres (float): Threshold for model 0 probability. Tunable.
+        vox_num_start (int): Starting voxel number. For batching purpose.
+        distance_type (str): Type of distance function to use. Options are:
+            "L1", "L2", "Cauchy", "Huber", "Welsch", "CvM".
+        validation_mode (bool): flag indicating whether to use validation mode.
+        hyperparameter (float): Hyperparameter value for the distance function.
+            Tunable.
+        host_buffers (tuple): Optional persistent pinned (para_host, 
+            model_p_host) numpy arrays reused across chunks; when given, the 
+            returned host results are views into them.
+
+    Returns:
+        tuple: A tuple containing the accepted parameter posteriors and model 
+            probabilities.
+    """
+    num_vox = Ct.shape[-1]
+    num_variable = 7
+
+    para_host = model_p_host = None
+    if host_buffers is not None:
+        para_host, model_p_host = host_buffers
+
+    voxel_numbers = cp.arange(num_vox) + vox_num_start
+
+    Ct = Ct.T[:, None, :] ## (num_vox, 1, num_time_frame), 
+                          ## second dimension for broadcasting
+    errors = distance_function(
+        M, 
+        Ct, 
+        distance_type = distance_type, 
+        validation_mode = validation_mode, 
+        hyperparameter = hyperparameter
+        )
+    ## calculate errors along time_frame axis
+    ## (num_vox, num_prior_simulation_size)
+    accepted_size = max(1, int(round(S * thresh)))
+    ## fixed acceptance count per voxel: the accepted_size smallest errors.
+    ## argpartition only partially sorts (O(S) instead of O(S log S)) and
+    ## breaks ties by position, so every voxel accepts exactly the same
+    ## number of simulations regardless of the distance function used.
+    ## This also removes the old risk of ties producing ragged acceptance
+    ## sizes and breaking the vectorisation.
+    accepted_indices = cp.argpartition(errors, accepted_size, 
+                                       axis = -1)[:, :accepted_size]
+    ## (num_vox, accepted_size)
+    accepted = par_mat[accepted_indices]
+    ## fancy indexing gathers the accepted rows for each voxel directly, 
+    ## without repeating par_mat per voxel first
+    ## (num_vox, accepted_size, num_variable)
+
+    accepted_models = model[accepted_indices] ## (num_vox, accepted_size)
+                                               ## models accepted for each voxel
+    percentage_zeros = cp.mean(accepted_models == 0, axis = -1)
+    ## along accepted_size axis
+    models = (percentage_zeros < model_0_prob_thres).astype(cp.int32)
+    model_p = cp.column_stack((voxel_numbers, models, percentage_zeros))
+    if model_p_host is not None:
+        model_p_out = model_p_host[:num_vox]
+        model_p.get(out = model_p_out)
+        ## lands in the persistent pinned buffer instead of a fresh
+        ## pageable allocation, so the copy needs no driver-side staging
+        model_p = model_p_out
+    else:
+        model_p = model_p.get()
+
+    if write_paras:
+        accepted = accepted.reshape(num_vox * accepted_size, num_variable)
+        voxel_numbers = voxel_numbers.repeat(accepted_size)
+        model_codes = accepted_models.reshape(num_vox * accepted_size)
+        accepted[:, 3:7][model_codes == 0] = cp.nan
+        ## gamma, t_D, t_P and alpha only exist under the lp-nt model, so
+        ## they are blanked for MRTM (model 0) rows before leaving the GPU
+        accepted = cp.column_stack((voxel_numbers, accepted, model_codes))
+        if para_host is not None:
+            para_out = para_host[:accepted.shape[0]]
+            accepted.get(out = para_out)
+            accepted = para_out
+        else:
+            accepted = accepted.get()
+    else:
+        accepted = None
+
+    return accepted, model_p
+
+def vABC(num_voxel, path_data, path_output_para, path_output_model, par_mat, 
+         model, S, thresh, model_0_prob_thres, write_paras, input_compressed=False, 
+         output_compressed=False, chunk_size=None, finer_t_size=1000, 
+         distance_type="L1", validation_mode=False, hyperparameter=None):
+    """
+    Performs the vABC (Variational Approximate Bayesian Computation) algorithm.
+
+    Args:
+        num_voxel (int): Number of voxels to process. If None, all voxels are
+        path_data (str): Path to the input data file.
+        path_output_para (str): Path to the parameter posterior output file.
+        path_output_model (str): Path to the model probability posterior output file.
+        par_mat (cp.ndarray): Kinetic parameter matrix, size 
+            (num_prior_simulation_size, num_variable). The model flag is not 
+            part of it, so the broadcast model tensor never carries it.
+        model (cp.ndarray): Model flag prior draws, size (num_prior_simulation_size,).
+        S (int): Size of the simulation. i.e. num_prior_simulation_size
+        thresh (float): Threshold value for acceptance. Tunable.
+        model_0_prob_thres (float): Threshold for model 0 probability. Tunable.
+        write_paras (bool): flag indicating whether to write parameter posterior.
+        input_compressed (bool): flag indicating whether the input data is compressed (hdf5/csv).
+        output_compressed (bool): flag indicating whether to compress the output 
+                                  posteriors (hdf5/csv).
+        chunk_size (int): Size of each chunk. Used to prevent memory 
+            overflow. When None, the largest batch that fits in free GPU 
+            memory (with headroom) is probed at start-up.
+        distance_type (str): Type of distance function to use. Options are:
+            "L1", "L2", "Cauchy", "Huber", "Welsch", "CvM".
+        validation_mode (bool): flag indicating whether to use validation mode.
+        hyperparameter (float): Hyperparameter value for the distance function.
+            Tunable.
+    """
+    if input_compressed:
+        hdf5_file = h5py.File(path_data, "r")
+        if "TACs" not in hdf5_file: ## pandas-written, row-oriented layout
+            hdf5_file.close()
+            print("Rechunking the input HDF5 column-wise...")
+            path_data = rechunk_input_hdf5(path_data, chunk_size)
+            hdf5_file = h5py.File(path_data, "r")
+        TAC_source = hdf5_file["TACs"]
+        df_column_size = TAC_source.shape[1] ## number of columns in the input
+        df = pd.DataFrame(TAC_source[:, :3])
+        ## extract_values only needs the three metadata columns
+    else:
+        df = pd.read_csv(path_data, usecols = range(3))
+        ## only time_frame_size, Ti, and Cb stay resident in host RAM; the
+        ## voxel columns are parsed lazily, one chunk at a time. Re-parsing
+        ## costs some CPU per chunk but keeps startup instant and the host
+        ## footprint flat regardless of study size.
+        TAC_source = path_data
+        df_column_size = pd.read_csv(path_data, nrows = 0).shape[1]
+    time_frame_size, Cr, Ti = extract_values(df)
+    Cr_cumsum = cp.cumsum(Cr, axis = 0)
+    print("Data extracted...")
+
+    if chunk_size is None:
+        free = cp.cuda.runtime.memGetInfo()[0]
+        num_time_frame = len(Ti)
+        bytes_per_voxel = S * (num_time_frame * 10 + 6) * 4
+        ## per voxel and simulation, generate_models materialises BigMat
+        ## (four planes), the masked Ct_ht terms and M over num_time_frame
+        ## values, and the distance step adds the float32 error row plus
+        ## the int64 argpartition indices and their workspace of length S
+        chunk_size = max(1, int(0.6 * free / bytes_per_voxel))
+        ## 40% of free memory stays as headroom for the pool's transients
+        if num_voxel is not None:
+            chunk_size = max(1, min(chunk_size, num_voxel))
+        print(f"Adaptive chunk size: {chunk_size} voxels per batch")
+
+    index = 3 ## ignoring the first 3 columns
+              ## which are for time_frame_size, Cb, and Ti
+
+    output_file_init(
+        path_output_para, 
+        path_output_model, 
+        write_paras, 
+        output_compressed
+        )
+    ## initialise the output files
+    print("Output files initialised...")
+
+    if num_voxel is None: ## When None, use all voxels
+        num_voxel = df_column_size - 3
+
+    # Calculate the number of iterations needed for the tqdm progress bar
+    total_iterations = min(num_voxel, df_column_size - 3) / chunk_size
+    total_iterations = int(total_iterations) if total_iterations.is_integer() else int(total_iterations) + 1
+
+    accepted_size = max(1, int(round(S * thresh)))
+    model_p_host = pin_host_array(np.empty((chunk_size, 3)))
+    para_host = None
+    if write_paras:
+        para_host = pin_host_array(
+            np.empty((chunk_size * accepted_size, len(PARA_ROW_DTYPE.names)))
+            )
+    ## persistent pinned landing buffers for the per-chunk device-to-host
+    ## copies: a page-locked destination lets the copy engine run at full
+    ## bandwidth, and nothing is reallocated between chunks
+
+    cp.cuda.set_pinned_memory_allocator(cp.cuda.PinnedMemoryPool().malloc)
+    ## staging buffers come from a pinned pool, so uploads are truly async
+    copy_stream = cp.cuda.Stream(non_blocking = True)
+    ## dedicated stream so the next chunk's H2D upload can overlap the
+    ## current chunk's kernels on the default stream
+    prefetched = extract_TAC_chunks(TAC_source, index, chunk_size, num_voxel, 
+                                    stream = copy_stream)
+
+    for _ in tqdm(range(total_iterations)):
+        ## batching to prevent memory overflow
+        if index >= df_column_size or index >= num_voxel + 3:
+            break
+
+        copy_stream.synchronize() ## make sure the upload has landed
+        Ct, pinned_buffer = prefetched
+        next_index = index + chunk_size
+        if next_index < df_column_size and next_index < num_voxel + 3:
+            prefetched = extract_TAC_chunks(TAC_source, next_index, chunk_size, 
+                                            num_voxel, stream = copy_stream)
+        ## the following chunk now uploads while this one computes
+
+        Ct_cumsum = cp.cumsum(Ct, axis = 0)
+        M = generate_models(
+            time_frame_size, Cr, Cr_cumsum, Ct, Ct_cumsum, Ti, par_mat, model
+        )
+        para, model_p = calculate_results(M, par_mat, model, Ct, S, thresh, 
+                                          write_paras, model_0_prob_thres, 
+                                          index - 3, 
+                                          distance_type = distance_type, 
+                                          validation_mode = validation_mode, 
+                                          hyperparameter = hyperparameter, 
+                                          host_buffers = (para_host, 
+                                                          model_p_host))
+        model_p_df = output_dataframe(model_p)
+        write_csv_chunks(para, model_p_df, path_output_para, path_output_model, 
+                         write_paras, output_compressed)
+
+        del Ct, pinned_buffer, Ct_cumsum, M, para, model_p, model_p_df
+        MEMORY_POOL.free_all_blocks()
+        ## neither pool returns blocks to the driver eagerly on its own;
+        ## releasing each chunk's transients keeps the memory ceiling flat
+        ## over long runs instead of fragmenting towards an OOM
+
+        index += chunk_size
+
+    if input_compressed:
+        hdf5_file.close()
+
+    print("vABC algorithm completed!")
+
+def main():
+    """
+    Main function that executes the vABC algorithm.
+    """
+
+    """
+    Input data file should have the shape:
+    frame_length	Ti	        Cb	        0	        1	        2
+    0	            0.133333333	0.632698	0.040760215	0.036601037	0.028408282
+    0.166666667	    0.35	    140.5885	18.177458	17.420736	16.563547
+    0.166666667	    0.516666667	17912.979	0	        0	        0
+    0.166666667	    0.683333333	4444.976	8.17E-08	6.64E-08	4.08E-08
+    0.166666667	    0.85	    2675.443	0.001335959	0.000509933	0.000515968
+
+    The following columns are all TACs of the voxels.
+    frame_length is the time frame size.
+    Ti is the time after administration of the tracer.
+    Cb is the whole blood input function.
+        (Or equavalently Ca, the plasma input function)
+
+    If input data is an HDF5 file, the key should be "df".
+    """
+    global MEMORY_POOL
+    try:
+        MEMORY_POOL = cp.cuda.MemoryAsyncPool()
+        cp.cuda.set_allocator(MEMORY_POOL.malloc)
+        ## delegate allocations to the driver's stream-ordered pool, which
+        ## recycles blocks across streams and defragments on its own, so
+        ## long runs with heavy allocation churn stop creeping towards OOM
+    except RuntimeError:
+        MEMORY_POOL = cp.get_default_memory_pool()
+        ## needs CUDA 11.2+ with driver support; keep the default pool
+
+    path_data = "../Code from Clara/data/vABC_data_null.csv"
+    path_output_para = "parameters.csv"
+    path_output_model = "model.csv"
+
+    seed = 2023
+    cp.random.seed(seed) ## for reproducibility
+
+    chunk_size = None ## None probes free GPU memory and picks the largest
+                      ## batch that fits; set an int to override
+
+    S = 2*10**6 ## number of prior simulations
+    thresh = 0.00029974212515947 ## threshold for acceptance
+    model_0_prob_thres = 0.5 ## threshold for model 0 probability
+    num_voxel = 100 ## number of voxels to process. If None, all voxels are
+    write_paras = True ## flag indicating whether to write parameter posterior
+    input_compressed = False ## flag indicating whether the input data is compressed (hdf5/csv)
+    output_compressed = False
+    ## flag indicating whether to compress the output 
+    ## posteriors (hdf5/csv).
+
+    distance_type = "L1" ## distance function to use
+    ## 
+    validation_mode = False ## flag indicating whether to use validation mode
+
+    par_mat = None
+    if validation_mode:
+    ## If validation mode is on, try to load precomputed models to save 
+    ## computation time
+        try:
+            priors = cp.load("parameter_matrix.npz")
+            par_mat = priors["par_mat"]
+            model = priors["model"]
+            print("Priors loaded...")
+        except FileNotFoundError:
+            pass
+    if par_mat is None:
+        model = cp.random.binomial(1, 0.5, S).astype(cp.uint8)
+        ## one byte per draw; a binary flag has no business being int64
+        ## the binary model indicator stays an independent Bernoulli draw,
+        ## outside the low-discrepancy core
+        sampler = qmc.Sobol(d = 7, scramble = True, seed = seed)
+        quasi = cp.asarray(sampler.random(S))
+        ## scrambled Sobol points fill the prior hypercube far more evenly
+        ## than pseudorandom draws, so the same S covers parameter space
+        ## more densely (the sequence is best balanced when S is a power
+        ## of two)
+        R1 = 0.2 + (1.7 - 0.2) * quasi[:, 0]
+        K2 = 0.1 + (0.45 - 0.1) * quasi[:, 1]
+        K2a = 0.1 * quasi[:, 2]
+        gamma = 0.4 * quasi[:, 3]
+        tD = 30 + (50 - 30) * quasi[:, 4]
+        tP = tD + 1 + (60 - tD - 1) * quasi[:, 5]
+        ## tP is conditionally uniform on (tD + 1, 60), so its Sobol
+        ## coordinate is rescaled per draw rather than globally
+        alpha = 4 * quasi[:, 6]
+        gamma[model == 0] = 0 ## model 0 for MRTM, model 1 for lp-nt
+
+        par_mat = cp.column_stack((R1, K2, K2a, gamma, tD, tP, alpha))
+        ## only the kinetic parameters are stacked; the model flag stays a
+        ## separate 1-D array so the broadcast model tensor never carries it
+        ## stacked as input
+        cp.savez_compressed("parameter_matrix", par_mat = par_mat, 
+                            model = model)
+        print("Priors generated...")
+
+    vABC(num_voxel, path_data, path_output_para, path_output_model, par_mat, 
+         model, S, thresh, model_0_prob_thres, write_paras, input_compressed, 
+         output_compressed, chunk_size, 
+         distance_type = distance_type, validation_mode = validation_mode, 
+         hyperparameter = None)
+    
+if __name__ == "__main__":
+    print("Starting vABC algorithm...")
     main()
\ No newline at end of file